@@ -3,21 +3,15 @@
 # coding: utf-8
 
 
-# #!pip3 install markdownify
-from bs4 import BeautifulSoup
-from markdownify import markdownify as md
-
-from pkg_resources import resource_string
-
-import lxml.html
 from lxml import etree
 
 from pathlib import Path
 
 import base64
+import copy
 
-# ##!pip3 install oyaml
-import oyaml as yaml
+# pandas, sqlite_utils and markdown are slow to import and only needed
+# by some of the functions in here, so they are imported where they are used.
 
 
 def checkDirPath(path):
@@ -43,68 +37,300 @@ def check_outdir(output_path_stub):
             os.makedirs(dirpath)
 
 import sqlite3
-from sqlite_utils import Database
 
-
-import pandas as pd
-from lxml import etree
+from ouxml.document import OUXMLDocument
+from ouxml.pipeline import TextPipeline
+from ouxml.buildmanifest import BuildManifest, content_hash
+from ouxml.dbquery import connection, query_row, query_rows
+from ouxml.units import create_unit_index, get_unit
+import ouxml.md_tools as mdtools
 
 
 def get_file(fn):
     """Get file content from local store."""
     # This should work locally or in package
-    try:
-        txt = resource_string(__name__, fn)
-    except:
-        txt = open(fn).read()
-    return txt
+    with open(_xslt_path(fn), "rb") as f:
+        return f.read()
 
 def get_xslt():
     """Return xlst file as text."""
 
 
-# TO DO - it would be better if the following accepted an XML string or the path to an XML file
-def transform_xml2md(xml, xslt="xslt/ouxml2md.xslt", output_path_stub=""):
-    """Take an OU-XML document as a string 
-       and transform the document to one or more markdown files."""
+# Compiled XSLT transformers, keyed on stylesheet path and modification time.
+# Compiling the stylesheet is much more expensive than applying it to a short
+# document, so we only want to do it once per process.
+_XSLT_CACHE = {}
 
-    if xml.endswith('.xml') and Path(xml).is_file():
-        with open(xml, 'r') as f:
-            xml = f.read()
 
-    check_outdir(output_path_stub)
+def _xslt_path(xslt):
+    """Resolve the filesystem path of a packaged or local stylesheet."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), xslt)
+    if os.path.isfile(path):
+        return path
+    return os.path.abspath(xslt)
 
-    _xslt = get_file(xslt)
 
-    xslt_doc = etree.fromstring(_xslt)
-    xslt_transformer = etree.XSLT(xslt_doc)
+def get_xslt_transformer(xslt="xslt/ouxml2md.xslt", in_memory=False):
+    """Return a compiled XSLT transformer, compiling the stylesheet at most once
+       for each (path, mtime). With in_memory, the stylesheet is compiled to
+       keep the documents it generates in the result tree rather than writing them."""
+    path = _xslt_path(xslt)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    key = (path, mtime, in_memory)
+    xslt_transformer = _XSLT_CACHE.get(key)
+    if xslt_transformer is None:
+        xslt_doc = etree.fromstring(get_file(xslt))
+        if in_memory:
+            xslt_doc = _in_memory_stylesheet(xslt_doc)
+        xslt_transformer = etree.XSLT(xslt_doc)
+        # Drop any stale compilation of the same stylesheet
+        for k in [k for k in _XSLT_CACHE if k[0] == path and k[2] == in_memory]:
+            del _XSLT_CACHE[k]
+        _XSLT_CACHE[key] = xslt_transformer
+    return xslt_transformer
+
+
+def clear_xslt_cache(xslt=None):
+    """Invalidate cached XSLT transformers, either for one stylesheet or all of them."""
+    if xslt is None:
+        _XSLT_CACHE.clear()
+        return
+    path = _xslt_path(xslt)
+    for key in [k for k in _XSLT_CACHE if k[0] == path]:
+        del _XSLT_CACHE[key]
+
+
+# In-memory output.
+# The stylesheet writes each output file with an exsl:document element.
+# For in-memory output, we compile a copy of the stylesheet in which each
+# exsl:document is replaced by an ouxml:document element in the result tree,
+# carrying the href, and then serialise each of those elements ourselves.
+_XSL_NS = "http://www.w3.org/1999/XSL/Transform"
+_EXSL_NS = "http://exslt.org/common"
+_OUXML_DOCUMENT_NS = "urn:ouxml:document"
+
+
+def _avt_instructions(parent, avt):
+    """Add XSLT instructions to parent that generate the value of an attribute value template."""
+    # Protect escaped braces while we split out the {expressions}
+    avt = avt.replace("{{", "\x00").replace("}}", "\x01")
+    for i, part in enumerate(re.split(r"[{}]", avt)):
+        if i % 2:
+            etree.SubElement(parent, "{%s}value-of" % _XSL_NS, select=part)
+        elif part:
+            text = part.replace("\x00", "{").replace("\x01", "}")
+            etree.SubElement(parent, "{%s}text" % _XSL_NS).text = text
+
+
+def _in_memory_stylesheet(xslt_doc):
+    """Rewrite a stylesheet so that exsl:document outputs are kept in the result tree."""
+    for el in list(xslt_doc.iter("{%s}document" % _EXSL_NS)):
+        # Use xsl:element rather than a literal result element so that the
+        # stylesheet namespaces are declared within each document, as they
+        # are when exsl:document writes it
+        new = etree.Element(
+            "{%s}element" % _XSL_NS, name="ouxml:document", namespace=_OUXML_DOCUMENT_NS
+        )
+        for name, value in el.attrib.items():
+            attr = etree.SubElement(new, "{%s}attribute" % _XSL_NS, name=name)
+            _avt_instructions(attr, value)
+        if el.text and el.text.strip():
+            etree.SubElement(new, "{%s}text" % _XSL_NS).text = el.text
+        for child in el:
+            new.append(child)
+        new.tail = el.tail
+        el.getparent().replace(el, new)
+    return xslt_doc
+
+
+# Serialisers for captured documents, keyed on output method
+_DOCUMENT_SERIALIZERS = {}
+
+
+def _document_serializer(method="xml"):
+    """Return a transformer that serialises a captured output document,
+       without any documents nested within it, as exsl:document would."""
+    if method not in _DOCUMENT_SERIALIZERS:
+        _DOCUMENT_SERIALIZERS[method] = etree.XSLT(
+            etree.XML(
+                f"""<xsl:stylesheet version="1.0" xmlns:xsl="{_XSL_NS}" xmlns:ouxml="{_OUXML_DOCUMENT_NS}">
+    <xsl:output method="{method}" encoding="UTF-8"/>
+    <xsl:template match="/"><xsl:apply-templates select="*/node()"/></xsl:template>
+    <xsl:template match="ouxml:document"/>
+    <xsl:template match="@*|node()"><xsl:copy><xsl:apply-templates select="@*|node()"/></xsl:copy></xsl:template>
+</xsl:stylesheet>"""
+            )
+        )
+    return _DOCUMENT_SERIALIZERS[method]
+
+
+def _captured_documents(output_doc):
+    """Get the documents captured by an in-memory transform as a dict of path -> content."""
+    files = {}
+    for el in output_doc.xpath("//ouxml:document", namespaces={"ouxml": _OUXML_DOCUMENT_NS}):
+        serializer = _document_serializer(el.get("method", "xml"))
+        # Serialise a copy so the document is the root, without its ancestors and siblings
+        content = bytes(serializer(copy.deepcopy(el))).decode("utf-8")
+        # A file written more than once only keeps its last contents
+        files[el.get("href")] = content
+    return files
+
+
+def write_files(files, only_changed=False):
+    """Write a dict of path -> content to disk.
+       With only_changed, files that already have that content are left
+       untouched. Returns the paths written."""
+    written = []
+    for path, content in files.items():
+        if only_changed and os.path.isfile(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    if f.read() == content:
+                        continue
+            except UnicodeDecodeError:
+                pass
+        check_outdir(path)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        written.append(path)
+    return written
+
+
+def _transform_manifest(error_log):
+    """Get the output files and the image sources used in each of them from the
+       messages the stylesheet reports, as a dict of lists keyed by file path."""
+    manifest = {}
+    # Output documents can be nested, eg the glossary is written from within the backmatter
+    documents = []
+    for entry in error_log:
+        parts = entry.message.split("\t")
+        if parts[0] == "ouxml-document":
+            # A file written more than once only keeps its last contents
+            manifest[parts[1]] = []
+            documents.append(parts[1])
+        elif parts[0] == "ouxml-document-end":
+            documents.pop()
+        elif parts[0] == "ouxml-image" and documents:
+            # Images outside any output document are not written anywhere
+            manifest[documents[-1]].append(parts[1])
+    return manifest
+
+
+def transform_xml2md(xml, xslt="xslt/ouxml2md.xslt", output_path_stub="", in_memory=False):
+    """Take an OU-XML document as a string, file path, OUXMLDocument or parsed element
+       and transform the document to one or more markdown files.
+       Returns a manifest of the files written and the image sources used in each.
+       With in_memory, nothing is written and a dict of path -> content for the
+       generated files is returned along with the manifest."""
+
+    if isinstance(xml, OUXMLDocument):
+        # Reuse the already parsed document
+        source_doc = xml.root
+    elif isinstance(xml, etree._Element):
+        source_doc = xml
+    elif xml.endswith('.xml') and Path(xml).is_file():
+        with open(xml, 'rb') as f:
+            source_doc = etree.fromstring(f.read())
+    else:
+        source_doc = etree.fromstring(xml.encode("utf-8"))
+
+    if not in_memory:
+        check_outdir(output_path_stub)
 
-    source_doc = etree.fromstring(xml.encode("utf-8"))
+    xslt_transformer = get_xslt_transformer(xslt, in_memory=in_memory)
 
-    # It would be handy if we could also retrieve what files the transformer generated?
-    # One way of doing this might be to pop everything into a temporary directory
-    # and then parse the contents of that directory into a database table?
+    # The stylesheet reports the files it generates, and the images in them,
+    # as messages that we can pick up from the error log
     output_doc = xslt_transformer(
         source_doc, filestub=etree.XSLT.strparam("{}".format(output_path_stub))
     )
+    manifest = _transform_manifest(xslt_transformer.error_log)
+    if in_memory:
+        return _captured_documents(output_doc), manifest
+    return manifest
 
 
-def transformer(conn, key, val, output_path_stub="testout"):
-    """Grab XML and trasnform it to individual markdown files and toc file."""
-    check_outdir(output_path_stub)
+def unit_xml(conn, key, val):
+    """Get the OU-XML that transformer() converts for a unit, the first unit
+       whose key column is exactly val, or None if there isn't one.
+       key is one of LOOKUP_KEYS; other keys raise a ValueError."""
+    unit = get_unit(conn, key, val, columns=["xml"])
+    return None if unit is None else unit["xml"]
+
+
+def transformer(conn, key, val, output_path_stub="testout", in_memory=False):
+    """Grab XML and trasnform it to individual markdown files and toc file.
+       With in_memory, return the generated files rather than writing them."""
+    if not in_memory:
+        check_outdir(output_path_stub)
 
-    # key / val is something like url / 1432311 ie a view resource ID
-    dummy_xml = pd.read_sql(
-        "SELECT * FROM htmlxml WHERE {} LIKE '%{}%'".format(key, val), conn
-    )["xml"]
-    # If there is more than one XML file returned, just go with the first one for now
-    # TO DO - improve this behaviour if multiple files are returned
-    dummy_xml = dummy_xml[0]
+    dummy_xml = unit_xml(conn, key, val)
+    if dummy_xml is None:
+        raise ValueError("No unit with {} {!r}".format(key, val))
     
     # Generate individual markdown files from sessions
-    transform_xml2md(dummy_xml, xslt="xslt/ouxml2md.xslt", output_path_stub=output_path_stub)
+    generated = transform_xml2md(
+        dummy_xml, xslt="xslt/ouxml2md.xslt", output_path_stub=output_path_stub, in_memory=in_memory
+    )
     # Generate table of contents as Unit_toc.md
     #transform_xml2md(dummy_xml, xslt="xslt/ouxml2toc.xslt", output_path_stub=output_path_stub)
+    return generated
+
+
+def _init_transform_worker(xslt="xslt/ouxml2md.xslt", in_memory=False):
+    """Warm the XSLT cache in a freshly started worker process."""
+    get_xslt_transformer(xslt, in_memory=in_memory)
+
+
+def _transform_unit(args):
+    """Transform a single unit from the database in memory; runs in a worker process."""
+    dbname, key, val, output_path_stub = args
+    conn = sqlite3.connect(dbname, timeout=10)
+    try:
+        return transformer(conn, key, val, output_path_stub, in_memory=True)
+    finally:
+        conn.close()
+
+
+def _transform_units_in_memory(dbname, output_path_stub, key, vals, jobs=1):
+    """Transform units to files in memory, returning (val, files, manifest) for each."""
+    if jobs is None or jobs <= 1:
+        conn = sqlite3.connect(dbname, timeout=10)
+        try:
+            return [
+                (val, *transformer(conn, key, val, output_path_stub, in_memory=True))
+                for val in vals
+            ]
+        finally:
+            conn.close()
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Nothing is written, so the units don't need to be kept apart
+    tasks = [(dbname, key, val, output_path_stub) for val in vals]
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_transform_worker,
+        initargs=("xslt/ouxml2md.xslt", True),
+    ) as pool:
+        results = list(pool.map(_transform_unit, tasks))
+    return [(val, files, manifest) for val, (files, manifest) in zip(vals, results)]
+
+
+# Get rid of excess end of lines
+_EXCESS_EOL_RE = re.compile(r"[\r\n][\r\n]{2,}")
+# Get rid of excess end of lines in code blocks
+_CODE_EXCESS_EOL_RE = re.compile(r"```python[\r\n]{2,}")
+
+
+def post_process_text(txt):
+    """Tidy up the text of a generated markdown file."""
+    txt = _EXCESS_EOL_RE.sub("\n\n", txt)
+    txt = _CODE_EXCESS_EOL_RE.sub("```python\n", txt)
+    return txt
 
 
 def _post_process(output_dir_path):
@@ -115,12 +341,7 @@ def _post_process(output_dir_path):
             with open(fnp) as f:
                 txt = _txt = f.read()
                 # Do postprocess step(s)
-
-                # Get rid of excess end of lines
-                txt = re.sub(r"[\r\n][\r\n]{2,}", "\n\n", txt)
-
-                # Get rid of excess end of lines in code blocks
-                txt = re.sub(r"```python[\r\n]{2,}", "```python\n", txt)
+                txt = post_process_text(txt)
 
             # Optionally rewrite the supplied markdown file with re-referenced image links
             if txt != _txt:
@@ -129,8 +350,6 @@ def _post_process(output_dir_path):
                     f.write(txt)
 
 
-# TO DO - we need a better form of pattern matching and rewriting
-# to allow more flexibility in the patterned naming of created directories and renamed files
 def _directory_processor(srcdir, new_suffix="part_"):
     """Take filenames of the form stub_WW_NN.md in a flat directory and map them to
        filenames of form the {new_suffix}_WW/stub_WW_NN.md in the same directory."""
@@ -159,94 +378,340 @@ def _directory_processor(srcdir, new_suffix="part_"):
 
 
 # https://stackoverflow.com/a/29280824/454773
-import markdown
-from markdown.treeprocessors import Treeprocessor
-from markdown.extensions import Extension
-
-# First create the treeprocessor
-
-
-class ImgExtractor(Treeprocessor):
-    def run(self, doc):
-        "Find all images and append to markdown.images. "
-        self.md.images = []
-        for image in doc.findall(".//img"):
-            self.md.images.append(image.get("src"))
-
-
-# Then tell markdown about it
-
-# TO DO - image processing
-# When handling images, it might be better to 
-# iterate through each image and replace the path with a UID.
-# Then create a lookup from UID to path.
-
-class ImgExtExtension(Extension):
-    def extendMarkdown(self, md):
-        img_ext = ImgExtractor(md)
-        md.treeprocessors.add("imgext", img_ext, ">inline")
-
-
-# Finally create an instance of the Markdown class with the new extension
-
-md = markdown.Markdown(extensions=[ImgExtExtension()])
+def _markdown_image_extractor():
+    """Build the markdown image extractor classes and a Markdown instance using them."""
+    import markdown
+    from markdown.treeprocessors import Treeprocessor
+    from markdown.extensions import Extension
+
+    # First create the treeprocessor
+
+    class ImgExtractor(Treeprocessor):
+        def run(self, doc):
+            "Find all images and append to markdown.images. "
+            self.md.images = []
+            for image in doc.findall(".//img"):
+                self.md.images.append(image.get("src"))
+
+    # Then tell markdown about it
+
+    # TO DO - image processing
+    # When handling images, it might be better to 
+    # iterate through each image and replace the path with a UID.
+    # Then create a lookup from UID to path.
+
+    class ImgExtExtension(Extension):
+        def extendMarkdown(self, md):
+            img_ext = ImgExtractor(md)
+            md.treeprocessors.add("imgext", img_ext, ">inline")
+
+    # Finally create an instance of the Markdown class with the new extension
+
+    md = markdown.Markdown(extensions=[ImgExtExtension()])
+    return {"ImgExtractor": ImgExtractor, "ImgExtExtension": ImgExtExtension, "md": md}
+
+
+def __getattr__(name):
+    # md, ImgExtractor and ImgExtExtension are only built if someone asks for them
+    if name in ("md", "ImgExtractor", "ImgExtExtension"):
+        globals().update(_markdown_image_extractor())
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Markdown image references can be found without rendering the markdown:
+# we just need to skip over code, and resolve reference style links.
+_MD_FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})\s*(.*)$")
+_MD_BLANK_RE = re.compile(r"^\s*$")
+_MD_INDENTED_RE = re.compile(r"^(?: {4}|\t)")
+_MD_LIST_RE = re.compile(r"^ {0,3}(?:[*+-]|\d+\.)\s")
+_MD_HEADING_RE = re.compile(r"^ {0,3}#")
+_MD_REFDEF_RE = re.compile(
+    r"^ {0,3}\[([^\[\]]*)\]:[ ]*\n?[ ]*(\S+)[ ]*(?:\n[ ]*)?"
+    r"(?:([\"'])(?:.*)\3[ ]*|\((?:.*)\)[ ]*)?$",
+    re.MULTILINE,
+)
+_MD_BACKTICK_RE = re.compile(r"(?<!\\)(`+)(.+?)(?<!`)\1(?!`)", re.DOTALL)
+_MD_TITLE_RE = re.compile(r"^(.*?)\s+([\"'])(?:.*)\2$", re.DOTALL)
+_MD_IMG_TAG_RE = re.compile(
+    r"<img\b[^>]*?\bsrc\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s>]+))", re.IGNORECASE
+)
+
+
+def _md_blocks(md_raw):
+    """Split markdown into the blocks that inline markup can appear in.
+       Fenced and indented code is dropped; MyST directive fences such as
+       ```{admonition} wrap markdown, so their contents are kept."""
+    blocks, block, fences = [], [], []
+    prev_blank, in_list, in_indented = True, False, False
+    for line in md_raw.split("\n"):
+        fence = _MD_FENCE_RE.match(line)
+        if fences and fences[-1][0] == "code":
+            # Only a closing fence ends a code block
+            _, chars = fences[-1]
+            if fence and not fence.group(2) and fence.group(1)[0] == chars[0] and len(fence.group(1)) >= len(chars):
+                fences.pop()
+            continue
+        if fence:
+            chars, info = fence.groups()
+            if fences and not info and chars[0] == fences[-1][1][0] and len(chars) >= len(fences[-1][1]):
+                fences.pop()
+            else:
+                fences.append(("directive" if info.startswith("{") else "code", chars))
+            blocks.append("\n".join(block))
+            block, prev_blank = [], True
+            continue
+        blank = _MD_BLANK_RE.match(line)
+        if not blank and _MD_INDENTED_RE.match(line) and (prev_blank or in_indented) and not in_list:
+            in_indented = True
+            continue
+        if blank:
+            blocks.append("\n".join(block))
+            block = []
+        elif _MD_HEADING_RE.match(line):
+            blocks.append("\n".join(block))
+            blocks.append(line)
+            block = []
+        else:
+            if not _MD_INDENTED_RE.match(line):
+                in_list = bool(_MD_LIST_RE.match(line))
+            block.append(line)
+        if not blank:
+            in_indented = False
+        prev_blank = bool(blank)
+    blocks.append("\n".join(block))
+    return [b for b in blocks if b]
+
+
+def _md_close(text, i, opening, closing):
+    """Find the index of the bracket that closes the one before i, or -1."""
+    depth = 1
+    while i < len(text):
+        ch = text[i]
+        if ch == "\\":
+            i = i + 2
+            continue
+        if ch == opening:
+            depth = depth + 1
+        elif ch == closing:
+            depth = depth - 1
+            if not depth:
+                return i
+        i = i + 1
+    return -1
+
+
+def _md_ref_id(text):
+    return " ".join(text.lower().split())
+
+
+def iter_md_image_srcs(md_raw):
+    """Yield the src of each image in markdown text, in document order.
+       This covers inline and reference style markdown images as well as
+       raw <img> tags, without rendering the markdown to HTML, and is safe
+       to use from several threads at once."""
+    refs = {}
+
+    def _refdef(m):
+        refs.setdefault(_md_ref_id(m.group(1)), m.group(2).lstrip("<").rstrip(">"))
+        return ""
+
+    blocks = [_MD_REFDEF_RE.sub(_refdef, block) for block in _md_blocks(md_raw)]
+    for block in blocks:
+        # Blank out code spans, keeping the offsets of everything else
+        block = _MD_BACKTICK_RE.sub(lambda m: " " * len(m.group(0)), block)
+        # Raw HTML images and markdown images are reported in the order they appear
+        found = [(m.start(), m.group(1) or m.group(2) or m.group(3) or "") for m in _MD_IMG_TAG_RE.finditer(block)]
+        i = 0
+        while True:
+            i = block.find("![", i)
+            if i < 0:
+                break
+            if i and block[i - 1] == "\\":
+                i = i + 2
+                continue
+            end = _md_close(block, i + 2, "[", "]")
+            if end < 0:
+                i = i + 2
+                continue
+            alt = block[i + 2 : end]
+            src = None
+            if block[end + 1 : end + 2] == "(":
+                close = _md_close(block, end + 2, "(", ")")
+                if close >= 0:
+                    link = block[end + 2 : close].strip()
+                    if link.startswith("<") and ">" in link:
+                        src = link[1 : link.index(">")]
+                    else:
+                        title = _MD_TITLE_RE.match(link)
+                        src = title.group(1) if title else link
+                    end = close
+            else:
+                ref = None
+                if block[end + 1 : end + 2] == "[":
+                    close = _md_close(block, end + 2, "[", "]")
+                    if close >= 0:
+                        ref = block[end + 2 : close] or alt
+                        if _md_ref_id(ref) in refs:
+                            end = close
+                src = refs.get(_md_ref_id(ref if ref is not None else alt))
+            if src is not None:
+                found.append((i, src.strip()))
+                i = end + 1
+            else:
+                i = i + 2
+        for _, src in sorted(found, key=lambda f: f[0]):
+            yield src
 
 
 def get_imgkeys_from_md(md_raw=None, md_filepath=None):
     """Generate imgkeys set for image paths in markdown file."""
 
     if md_raw is None and md_filepath is not None:
-        md_raw = open(md_filepath).read()
+        with open(md_filepath) as f:
+            md_raw = f.read()
+
+    return imgkeys_from_srcs(iter_md_image_srcs(md_raw))
 
-    html = md.convert(md_raw)
+
+def imgkeys_from_srcs(images):
+    """Generate imgkeys set for a list of image paths."""
+
+    images = list(images)
 
     # The img URLs may be in one of two forms:
 
     imgkeys = {}
 
     # \\\\DCTM_FSS\\content\\Teaching and curriculum\\Modules\\T Modules\\TM112\\TM112 materials\\Block 1 e1\\Block 1 Part 1\\_Assets\\tm112_intro_table_01.eps
-    imgkeys.update({u: u.split("\\")[-1] for u in md.images if "\\" in u})
+    imgkeys.update({u: u.split("\\")[-1] for u in images if "\\" in u})
 
     # https://openuniv.sharepoint.com/sites/tmodules/tm112/block2e1/tm112_blk02_pt04_f07.tif
-    imgkeys.update({u: u.split("/")[-1] for u in md.images if "/" in u})
+    imgkeys.update({u: u.split("/")[-1] for u in images if "/" in u})
 
     return imgkeys
 
 
+def _image_data_sql(conn, alias="i"):
+    """SQL select list and join for the image data associated with imagetest rows.
+       Raw BLOBs are identified by table and rowid so they can be streamed rather
+       than loaded; legacy base64 data is returned as is."""
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(imagetest)")]
+    tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    if "hash" in columns and "imagestore" in tables:
+        return (
+            """COALESCE(s.rowid, {a}.rowid) AS imgid,
+               CASE WHEN s.rowid IS NOT NULL THEN 'imagestore' ELSE 'imagetest' END AS imgtable,
+               CASE WHEN s.rowid IS NULL AND {a}.image IS NULL THEN {a}.b64image END AS b64image""".format(
+                a=alias
+            ),
+            "LEFT JOIN imagestore s ON s.hash={}.hash".format(alias),
+        )
+    if "image" in columns:
+        return (
+            """{a}.rowid AS imgid, 'imagetest' AS imgtable,
+               CASE WHEN {a}.image IS NULL THEN {a}.b64image END AS b64image""".format(
+                a=alias
+            ),
+            "",
+        )
+    return "NULL AS imgid, NULL AS imgtable, {}.b64image AS b64image".format(alias), ""
+
+
+def _same_page_sql(conn, pagecol, alias="i"):
+    """SQL condition matching imagetest rows to figures on the same page.
+       Images saved before they were keyed by page match figures on any page."""
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(imagetest)")]
+    if "pageurl" not in columns:
+        return "1"
+    return "({a}.pageurl IS NULL OR {a}.pageurl={p})".format(a=alias, p=pagecol)
+
+
 def generate_imgdict(imgkeys, DB):
     """Automatically generate an imgdict that maps agains links in a markdown file."""
 
+    imgcols, imgjoin = _image_data_sql(DB.conn)
     q = """
-        SELECT DISTINCT xurl, h.stub as p , b64image
-        FROM htmlfigures h JOIN xmlfigures x JOIN imagetest i
+        SELECT DISTINCT xurl, h.stub as p, {}
+        FROM htmlfigures h JOIN xmlfigures x JOIN imagetest i {}
         WHERE x.minstub=h.minstub 
-        AND i.stub=h.stub
+        AND i.stub=h.stub AND {}
         AND x.stub in ({});
         """.format(
-        ", ".join(['"{}"'.format(imgkeys[k]) for k in imgkeys])
+        imgcols, imgjoin, _same_page_sql(DB.conn, "h.hpageurl"), ", ".join("?" * len(imgkeys))
     )
-    tmp_img = pd.read_sql(q, DB.conn)
-    imgdict = tmp_img.set_index("xurl").to_dict()["p"]
+    tmp_img = list(query_rows(DB.conn, q, [imgkeys[k] for k in imgkeys]))
+    imgdict = {row["xurl"]: row["p"] for row in tmp_img}
 
-    # Return the dataframe from which we can save the images to disk
+    # Return the rows from which we can save the images to disk
     return tmp_img, imgdict
 
 
 # OU_Course_Material_Assets.ipynb currently has scraper for getting a database together
 
 
-def _crossmatch_xml_html_links(imgdict, fn, imgdirpath="", rewrite=False):
-    """ Try to reconcile XML paths to HTML image paths in supplied markdown file. """
+def _trie_pattern(keys):
+    """Build a regular expression matching any of the keys, longest first.
+       The keys are arranged as a trie, so the pattern only ever has to try
+       the keys that share the prefix matched so far."""
+    trie = {}
+    for key in keys:
+        node = trie
+        for ch in key:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def _pattern(node):
+        alternatives = []
+        for ch in sorted(c for c in node if c):
+            # Collapse chains of single children into literal runs
+            run, child = ch, node[ch]
+            while len(child) == 1 and "" not in child:
+                (nextch,) = child
+                run, child = run + nextch, child[nextch]
+            alternatives.append(re.escape(run) + _pattern(child))
+        if not alternatives:
+            return ""
+        pattern = alternatives[0] if len(alternatives) == 1 else "(?:{})".format("|".join(alternatives))
+        if "" in node:
+            # Greedy, so a longer key is preferred to a shorter one
+            if len(alternatives) == 1:
+                pattern = "(?:{})".format(pattern)
+            pattern = pattern + "?"
+        return pattern
+
+    return re.compile(_pattern(trie))
+
+
+def link_rewriter(imgdict, imgdirpath=""):
+    """Compile an imgdict into a function that rewrites the XML image paths in
+       markdown text to paths into the image directory in a single scan."""
+    targets = {}
+    for k in imgdict:
+        key = k.lstrip("\\")
+        # An empty key would match everywhere
+        if key:
+            targets.setdefault(key, os.path.join(imgdirpath, imgdict[k]))
+    if not targets:
+        return lambda txt: txt
+    pattern = _trie_pattern(targets)
+    return lambda txt: pattern.sub(lambda m: targets[m.group(0)], txt)
+
+
+def _crossmatch_xml_html_links(
+    imgdict, fn, imgdirpath="", rewrite=False, rewriter=None
+):
+    """ Try to reconcile XML paths to HTML image paths in supplied markdown file.
+        When handling several files, pass in a rewriter from link_rewriter()
+        so that it is only compiled once. """
+
+    rewriter = rewriter or link_rewriter(imgdict, imgdirpath)
 
     # Open the markdown file
     with open(fn) as f:
         txt = _txt = f.read()
-        # Replace image references with actual image links
-        for k in imgdict:
-            # print(k.lstrip('\\'))
-            txt = txt.replace(
-                k.lstrip("\\"), "{}".format(os.path.join(imgdirpath, imgdict[k]))
-            )
+    # Replace image references with actual image links
+    txt = rewriter(txt)
 
     # Optionally rewrite the supplied markdown file with re-referenced image links
     if rewrite and (txt != _txt):
@@ -273,19 +738,70 @@ def crossmatch_xml_html_links(
     if content_prefix:
         candidate_files = [f for f in candidate_files if f.startswith(content_prefix)]
 
+    rewriter = link_rewriter(imgdict, imgdirpath)
     for fn in candidate_files:
         print("Handling {}".format(fn))
-        _ = _crossmatch_xml_html_links(imgdict, fn, imgdirpath, rewrite=True)
+        _ = _crossmatch_xml_html_links(
+            imgdict, fn, imgdirpath, rewrite=True, rewriter=rewriter
+        )
         # We could save the md files to a table here, and perhaps also convert to ipynb in same table?
 
 
-def save_image_from_db(x, imgdir="testimages"):
-    """ Save image in db to file. """
+def _write_blob(conn, rowid, fn, table="imagetest", column="image", chunk_size=65536):
+    """Stream a BLOB from the database to a file without loading it all into memory."""
+    if not hasattr(conn, "blobopen"):
+        # Incremental BLOB I/O needs Python 3.11+
+        (img_data,) = conn.execute(
+            "SELECT {} FROM {} WHERE rowid=?".format(column, table), (rowid,)
+        ).fetchone()
+        with open(fn, "wb") as f:
+            f.write(img_data)
+        return
+    with conn.blobopen(table, column, rowid, readonly=True) as blob:
+        with open(fn, "wb") as f:
+            while True:
+                data = blob.read(chunk_size)
+                if not data:
+                    break
+                f.write(data)
+
+
+def _same_file_content(fn, data):
+    """Check whether a file already has the given content."""
+    if not os.path.isfile(fn) or os.path.getsize(fn) != len(data):
+        return False
+    with open(fn, "rb") as f:
+        return f.read() == data
+
+
+def save_image_from_db(x, imgdir="testimages", conn=None, only_changed=False):
+    """ Save image in db to file.
+        With only_changed, an existing file with the same content is left untouched. """
 
-    img_data = x["b64image"]  # sql("SELECT * FROM imagetest  LIMIT 1;")[0]['b64image']
     fn = "{}/{}".format(imgdir, x["p"])
+    img_data = x["b64image"]  # sql("SELECT * FROM imagetest  LIMIT 1;")[0]['b64image']
+    if img_data is None and conn is not None:
+        # Raw image data is stored as a BLOB
+        if only_changed and os.path.isfile(fn):
+            (size,) = conn.execute(
+                "SELECT length(image) FROM {} WHERE rowid=?".format(x["imgtable"]),
+                (int(x["imgid"]),),
+            ).fetchone()
+            if os.path.getsize(fn) == size:
+                (img_data,) = conn.execute(
+                    "SELECT image FROM {} WHERE rowid=?".format(x["imgtable"]),
+                    (int(x["imgid"]),),
+                ).fetchone()
+                if _same_file_content(fn, img_data):
+                    return fn
+        _write_blob(conn, int(x["imgid"]), fn, table=x["imgtable"])
+        return fn
+
+    img_data = base64.decodebytes(img_data)
+    if only_changed and _same_file_content(fn, img_data):
+        return fn
     with open(fn, "wb") as f:
-        f.write(base64.decodebytes(img_data))
+        f.write(img_data)
 
     return fn
 
@@ -295,57 +811,98 @@ def save_image_from_db(x, imgdir="testimages"):
 # Rewrite imagelinks as stubs
 # BUT  - we need some sort of secret for the image file dereferencing to work?
 # save images
-def openlearn_image_mapper(dbname, _basedir="oumd_demo3", _imgdir="testimages"):
-    def _generate_imgdict(DB, imgkeys):
-        """Automatically generate an imgdict that maps agains links in a markdown file."""
-
-        q = """
-            SELECT DISTINCT srcurl, x.stub as p, b64image
-            FROM xmlfigures x JOIN imagetest i
-            WHERE x.minstub=i.minstub AND x.minstub in ({});
-            """.format(
-            ", ".join(['"{}"'.format(imgkeys[k].split('.')[0]) for k in imgkeys])
+def _resolve_openlearn_images(conn, minstubs):
+    """Look up the figures and image data for a set of image minstubs in one query.
+       Each figure gets the image saved for its own page, and rows come back
+       in scrape order, so that later rows win if figures still clash."""
+    imgcols, imgjoin = _image_data_sql(conn)
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _imgkeys (minstub TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM _imgkeys")
+    conn.executemany(
+        "INSERT OR IGNORE INTO _imgkeys VALUES (?)", [(m,) for m in minstubs]
+    )
+    rows = list(
+        query_rows(
+            conn,
+            """
+            SELECT DISTINCT srcurl, x.stub as p, {}
+            FROM _imgkeys k JOIN xmlfigures x ON x.minstub=k.minstub
+            JOIN imagetest i ON x.minstub=i.minstub AND {} {}
+            ORDER BY x.rowid, i.rowid;
+            """.format(imgcols, _same_page_sql(conn, "x.xpageurl"), imgjoin),
         )
-        tmp_img = pd.read_sql(q, DB.conn)
-        imgdict = tmp_img.set_index("srcurl").to_dict()["p"]
+    )
+    conn.execute("DROP TABLE _imgkeys")
+    return rows
 
-        # Return the dataframe from which we can save the images to disk
-        return tmp_img, imgdict
 
+def openlearn_image_rewriter(
+    dbname, files, imgdirpath, _imgdir="images", manifest=None, only_changed=False
+):
+    """Save the images used by a dict of markdown path -> text into imgdirpath
+       and return a function that rewrites the image links to point to them.
+       Image keys are collected from every file first and resolved in a single
+       query, and each image is written once.
+       If we have the manifest from the transform, files listed in it
+       don't need to be searched for images.
+       With only_changed, image files that are already up to date are left untouched."""
     conn = sqlite3.connect(dbname, timeout=10)
-    cursor = conn.cursor()
-
-    DB = Database(conn)
-    imgdirpath = os.path.join(_basedir, _imgdir)
     checkDirPath(imgdirpath)
 
+    manifest = {
+        os.path.normpath(path): srcs for path, srcs in (manifest or {}).items()
+    }
+
+    # Collect the image keys for all the files
+    minstubs = set()
+    for path, txt in files.items():
+        if os.path.normpath(path) in manifest:
+            imgkeys = imgkeys_from_srcs(manifest[os.path.normpath(path)])
+        else:
+            imgkeys = get_imgkeys_from_md(md_raw=txt)
+        minstubs.update(imgkeys[k].split(".")[0] for k in imgkeys)
+
+    rows = _resolve_openlearn_images(conn, minstubs)
+    imgdict = {row["srcurl"]: row["p"] for row in rows}
+
+    # Save each image once
+    images = {row["p"]: row for row in rows}
+    for row in images.values():
+        save_image_from_db(row, imgdir=imgdirpath, conn=conn, only_changed=only_changed)
+    conn.close()
+
+    return link_rewriter(imgdict, _imgdir)
+
+
+def openlearn_image_mapper(
+    dbname, _basedir="oumd_demo3", _imgdir="testimages", manifest=None
+):
+    """Save the images used by the markdown files in a directory and rewrite
+       the image links to point to them, rewriting each file once."""
+
     # Should this cope with nested directories and put an image dir in each content dir
     # or one image dir for the whole course?
-    imgdict = {}
 
     # Detect markdown files
     candidate_files = [f for f in os.listdir(_basedir) if re.match(".*\.md$", f)]
 
+    texts = {}
     for fn in candidate_files:
-        imgkeys = get_imgkeys_from_md(md_filepath="{}/{}".format(_basedir, fn))
-
-        # for each page, get the links
-        tmp_img, _imgdict = _generate_imgdict(DB, imgkeys)
-        imgdict = {**imgdict, **_imgdict}
+        with open(os.path.join(_basedir, fn)) as f:
+            texts[os.path.join(_basedir, fn)] = f.read()
 
-        # for each page, save the images
-        tmp_img.apply(
-            lambda x: save_image_from_db(x, imgdir=os.path.join(_basedir, _imgdir)),
-            axis=1,
-        )
+    rewriter = openlearn_image_rewriter(
+        dbname, texts, os.path.join(_basedir, _imgdir), _imgdir, manifest=manifest
+    )
 
-    # We need to go round again having collected all the image keys
-    for fn in candidate_files:
-        # Rewrite the links
-        print("Handling {}".format(fn))
-        _ = _crossmatch_xml_html_links(
-            imgdict, os.path.join(_basedir, fn), _imgdir, rewrite=True
-        )
+    # Rewrite the links
+    for path, _txt in texts.items():
+        print("Handling {}".format(os.path.basename(path)))
+        txt = rewriter(_txt)
+        if txt != _txt:
+            print("Rewriting {}".format(path))
+            with open(path, "w") as f:
+                f.write(txt)
 
 
 def _process_ouxml_doc(row, DB=None, _basedir="", _imgdir=""):
@@ -361,22 +918,25 @@ def _process_ouxml_doc(row, DB=None, _basedir="", _imgdir=""):
     # if len(pages):
     # for each page, transform it
     check_outdir(output_path_stub)
-    transform_xml2md(row["xml"], output_path_stub=output_path_stub)
+    manifest = transform_xml2md(row["xml"], output_path_stub=output_path_stub)
+    manifest = {os.path.normpath(path): srcs for path, srcs in manifest.items()}
 
     imgdict = {}
     # for each page get the image links
     for page in os.listdir(output_path_dir):
-        imgkeys = get_imgkeys_from_md(md_filepath="{}/{}".format(output_path_dir, page))
+        page_path = os.path.normpath(os.path.join(output_path_dir, page))
+        if page_path in manifest:
+            imgkeys = imgkeys_from_srcs(manifest[page_path])
+        else:
+            imgkeys = get_imgkeys_from_md(md_filepath=page_path)
 
         # for each page, rewrite the links
         tmp_img, _imgdict = generate_imgdict(imgkeys, DB)
         imgdict = {**imgdict, **_imgdict}
 
         # for each page, save the images
-        tmp_img.apply(
-            lambda x: save_image_from_db(x, imgdir=os.path.join(_basedir, _imgdir)),
-            axis=1,
-        )
+        for x in tmp_img:
+            save_image_from_db(x, imgdir=os.path.join(_basedir, _imgdir), conn=DB.conn)
 
     crossmatch_xml_html_links(
         imgdict,
@@ -395,12 +955,17 @@ def _process_ouxml_doc(row, DB=None, _basedir="", _imgdir=""):
 # +
 # https://stackoverflow.com/a/47965711/454773  
 
+def subdir_image_paths(txt):
+    """Update image paths in a file moved down into a subdirectory."""
+    return txt.replace('](images/', '](../images/')
+
+
 def update_image_paths(path):
     """Update image paths in restructure file directories."""
     for filepath in glob.iglob(f'{path.rstrip("/")}/*.md', recursive=True):
         with open(filepath) as file:
             s = file.read()
-        s = s.replace('](images/', '](../images/')
+        s = subdir_image_paths(s)
         with open(filepath, "w") as file:
             file.write(s)
 
@@ -419,27 +984,32 @@ Contents:
 {_toc_list}
 '''
 
+def _toc_unit(dbname='openlearn_oer.db', DB=None):
+    """Get the url and title of the (first) unit in the database for a table of contents.
+       DB may be a sqlite_utils Database or a sqlite3 connection."""
+    conn = sqlite3.connect(dbname) if DB is None else connection(DB)
+    try:
+        unit = query_row(conn, "SELECT html_url, itemTitle FROM htmlxml ORDER BY rowid LIMIT 1")
+    finally:
+        if DB is None:
+            conn.close()
+    return unit['html_url']+'/content-section-0', unit['itemTitle']
+
 def create_minimal_toc_from_dir(path='.', dbname='openlearn_oer.db', DB=None):
     """Create minimal table of contents from content directory."""
-    if DB is None:
-        DB = Database(dbname)
-
     _toc_list = ''
     for d in sorted([d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)) and d != 'images']):
         session = d.replace("_", " ").capitalize()
         _toc_list = f'{_toc_list}\n\n{session}\n{len(session)*"-"}\n\n'
         _toc_list = f'{_toc_list}\n.. toctree::\n    :maxdepth: 2\n    :glob:\n\n    {os.path.join(path, d, "*")}\n'
         
-    url = pd.read_sql("SELECT * FROM htmlxml ", DB.conn)['html_url'][0]+'/content-section-0'
-    title = pd.read_sql("SELECT * FROM htmlxml ", DB.conn)['itemTitle'][0]
+    url, title = _toc_unit(dbname, DB)
     _title = '='*len(title)
     return _toc.format(title=title, _title=_title, _toc_list=_toc_list, url=url)
 
 def create_simple_toc_from_dir(path='.', dbname='openlearn_oer.db', DB=None):
     """Create table of contents from directory."""
-    if DB is None:
-        DB = Database(dbname)
-    url = pd.read_sql("SELECT * FROM htmlxml ", DB.conn)['html_url'][0]+'/content-section-0'
+    url, title = _toc_unit(dbname, DB)
     _toc_list = ''
     for root, paths, files in os.walk(path):
         paths.sort()
@@ -451,7 +1021,6 @@ def create_simple_toc_from_dir(path='.', dbname='openlearn_oer.db', DB=None):
                     header = f.readline()
                     cleanpath = os.path.splitext(fpath)[0]
                     _toc_list = f'{_toc_list}\n.. toctree::\n    :maxdepth: 2\n    :caption: {header.lstrip("#").strip()}\n\n    {cleanpath}\n'
-    title = pd.read_sql("SELECT * FROM htmlxml ", DB.conn)['itemTitle'][0]
     _title = '='*len(title)
     return _toc.format(title=title, _title=_title, _toc_list=_toc_list, url=url)
 
@@ -465,6 +1034,13 @@ def create_simple_toc_from_dir(path='.', dbname='openlearn_oer.db', DB=None):
 
 # -
 
+def subdir_path(path, dirstub='session'):
+    """Get the path in its chapter subdirectory for a file of the form STUB_MM_NN.md."""
+    dirname, f = os.path.split(path)
+    chapter = f.split('_')[1]
+    return os.path.join(dirname, f'{dirstub}_{chapter}/{f}')
+
+
 def split_into_subdirs(path, dirstub='session'):
     """
     Split flat file structure generated by OpenLearn process into subdirs.
@@ -483,15 +1059,14 @@ def split_into_subdirs(path, dirstub='session'):
         os.makedirs(os.path.join(path, f'{dirstub}_{chapter}'))
 
     for f in [f for f in os.listdir(path) if f.endswith('.md')]:
-        section = f.split('_')[1]
         oldname = os.path.join(path, f'{f}')
-        newname = os.path.join(path, f'{dirstub}_{section}/{f}')
+        newname = subdir_path(oldname, dirstub)
         os.rename(oldname, newname)
         
         # Reset image paths first
         with open(newname) as file:
             s = file.read()
-        s = s.replace('](images/', '](../images/')
+        s = subdir_image_paths(s)
         with open(newname, "w") as file:
             file.write(s)
             
@@ -500,6 +1075,168 @@ def split_into_subdirs(path, dirstub='session'):
         # This should be: individual numbered sessions and name sections within them
 
 
+def conversion_pipeline(rewriter=None, dirstub='session', clean=False):
+    """Build the pipeline of text transforms that are applied to the generated
+       markdown files before they are written: rewriting the image links,
+       moving the files into subdirectories and, optionally, tidying them up."""
+    pipeline = TextPipeline()
+    if rewriter is not None:
+        pipeline.add("image links", lambda path, txt: (path, rewriter(txt)))
+    if dirstub:
+        pipeline.add(
+            "subdirs", lambda path, txt: (subdir_path(path, dirstub), subdir_image_paths(txt))
+        )
+    if clean:
+        pipeline.add("post process", lambda path, txt: (path, post_process_text(txt)))
+        pipeline.add("clean md", lambda path, txt: (path, mdtools.clean_md_text(txt)))
+    return pipeline
+
+
+# Bump this if the rewriting stages (conversion_pipeline(), the image
+# rewriter) change what they generate, so that units get converted again
+CONVERTER_VERSION = 1
+
+
+def _unit_xml_hashes(conn, key):
+    """Get the hash of the OU-XML converted for each value of key, as unit_xml()
+       finds it, from the hashes stored when units were scraped where we have them."""
+    # Databases created before incremental scrapes don't have hashes
+    columns = {row["name"] for row in query_rows(conn, "PRAGMA table_info(htmlxml)")}
+    xml_hash = "xml_hash" if "xml_hash" in columns else "NULL"
+    hashes = {}
+    for val, _hash, xml in conn.execute(
+        """SELECT [{key}], {xml_hash}, CASE WHEN {xml_hash} IS NULL THEN xml END
+           FROM htmlxml ORDER BY rowid""".format(key=key, xml_hash=xml_hash)
+    ):
+        # Units are looked up by the first row with their key
+        if val not in hashes:
+            hashes[val] = _hash if _hash is not None or xml is None else content_hash(xml)
+    return hashes
+
+
+def convert_units(
+    dbname, outdir, prefix="Part", key="itemTitle", jobs=1, clean=False, incremental=False
+):
+    """Convert the units in the database to markdown files in outdir.
+       The files are generated and rewritten in memory, and each file is written once.
+       A build manifest in the database records what each unit was built from
+       and the files it generated. With incremental, only units whose OU-XML,
+       stylesheet or options changed are reconverted, files they no longer
+       generate are removed, and files whose content is unchanged are left untouched.
+       Returns the pipeline, which has the timings for each rewriting stage."""
+    outpath = os.path.join(outdir, prefix)
+    conn = sqlite3.connect(dbname, timeout=10)
+    # Units are looked up by key for each conversion
+    create_unit_index(conn)
+    vals = [r[0] for r in conn.execute("SELECT {} FROM htmlxml".format(key))]
+    # A unit listed more than once overwrites files as of its last appearance
+    order = {val: i for i, val in enumerate(vals)}
+    units = sorted(order, key=order.get)
+
+    xml_hashes = _unit_xml_hashes(conn, key)
+    xslt_hash = content_hash(
+        content_hash(get_file("xslt/ouxml2md.xslt"))
+        + repr((prefix, clean, CONVERTER_VERSION, mdtools.CLEAN_MD_VERSION))
+    )
+
+    build = BuildManifest(conn, outdir)
+    if not incremental:
+        build.clear()
+    built = build.units()
+    built_files = build.files()
+
+    def _missing(val):
+        return any(not os.path.isfile(os.path.join(outdir, path)) for path in built_files.get(val, {}))
+
+    todo = {
+        val for val in units if built.get(val) != (xml_hashes[val], xslt_hash) or _missing(val)
+    }
+    print(f"Converting {len(todo)} of {len(units)} units")
+
+    # Which units generate each file, as of their last build
+    claims = {}
+    for val, paths in built_files.items():
+        if val in order:
+            for path in paths:
+                claims.setdefault(path, set()).add(val)
+
+    # Map generated file paths to where the pipeline puts them
+    paths_pipeline = conversion_pipeline()
+
+    def _relpath(path):
+        return os.path.relpath(paths_pipeline.process(path, "")[0], outdir)
+
+    # When units generate the same file, the last one wins, so if we rebuild
+    # one of them we have to rebuild them all to know what the file should be.
+    generated = {}
+    while todo:
+        for val in list(todo):
+            for path in built_files.get(val, {}):
+                todo.update(claims.get(path, set()))
+        todo = todo - set(generated)
+        for val, files, manifest in _transform_units_in_memory(
+            dbname, outpath, key, [val for val in units if val in todo], jobs
+        ):
+            generated[val] = (files, manifest)
+            for path in files:
+                claims.setdefault(_relpath(path), set()).add(val)
+        todo = {
+            other
+            for val in todo
+            for path in generated[val][0]
+            for other in claims[_relpath(path)]
+            if other not in generated
+        }
+
+    # Merge the generated files in database order
+    files = {}
+    manifest = {}
+    for val in units:
+        if val in generated:
+            files.update(generated[val][0])
+            manifest.update(generated[val][1])
+
+    pipeline = conversion_pipeline(clean=clean)
+    if files:
+        rewriter = openlearn_image_rewriter(
+            dbname,
+            files,
+            os.path.join(outdir, "images"),
+            "images",
+            manifest=manifest,
+            only_changed=incremental,
+        )
+        pipeline = conversion_pipeline(rewriter, clean=clean)
+    outfiles = pipeline.run(files)
+    written = write_files(outfiles, only_changed=True)
+    print(f"Wrote {len(written)} of {len(outfiles)} files")
+
+    # Record what we built
+    hashes = {os.path.relpath(path, outdir): content_hash(txt) for path, txt in outfiles.items()}
+    for val, (unit_files, _) in generated.items():
+        unit_paths = [_relpath(path) for path in unit_files]
+        build.record(
+            val, xml_hashes[val], xslt_hash, {path: hashes[path] for path in unit_paths}
+        )
+
+    # Remove files that are no longer generated by any unit
+    for val in set(built) - set(units):
+        build.forget(val)
+    current = set().union(*build.files().values())
+    stale = set().union(*built_files.values()) - current
+    for path in sorted(stale):
+        fn = os.path.join(outdir, path)
+        if os.path.isfile(fn):
+            print(f"Removing {fn}")
+            os.remove(fn)
+            # Tidy away session directories we have emptied
+            dirname = os.path.dirname(fn)
+            if os.path.abspath(dirname) != os.path.abspath(outdir) and not os.listdir(dirname):
+                os.rmdir(dirname)
+    conn.close()
+    return pipeline
+
+
 # ## Table of contents generator
 #
 # This is achieved via an XSLT when the original files are generated.
@@ -561,6 +1298,8 @@ def section(title, url, sections=None, not_numbered="true", expand_sections="tru
 # +
 def generate_section_df(path='.', stub='Part_', suffix='md'):
     """Generate a dataframe to help structure generated markdown files."""
+    import pandas as pd
+
     rows=[]
 
     for fn in [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)) 
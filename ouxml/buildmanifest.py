@@ -0,0 +1,100 @@
+# buildmanifest.py
+
+# A record, kept in the database, of what each unit was last converted from
+# (the hash of its OU-XML and of the stylesheet and conversion options) and
+# the files that were generated from it, so that a rebuild only needs to
+# reconvert the units that changed and remove the files they no longer generate.
+
+import hashlib
+import os
+
+create_build_units = """
+CREATE TABLE IF NOT EXISTS "build_units" (
+  "outdir" TEXT,
+  "unit" TEXT,
+  "xml_hash" TEXT,
+  "xslt_hash" TEXT,
+  PRIMARY KEY ("outdir", "unit")
+);
+"""
+
+# A file may be generated by more than one unit, in which case the last one wins
+create_build_files = """
+CREATE TABLE IF NOT EXISTS "build_files" (
+  "outdir" TEXT,
+  "path" TEXT,
+  "unit" TEXT,
+  "content_hash" TEXT,
+  PRIMARY KEY ("outdir", "path", "unit")
+);
+"""
+
+
+def content_hash(content):
+    """Hash text or bytes content."""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+class BuildManifest:
+    """The build manifest for one output directory."""
+
+    def __init__(self, conn, outdir):
+        self.conn = conn
+        self.outdir = os.path.abspath(outdir)
+        with conn:
+            conn.execute(create_build_units)
+            conn.execute(create_build_files)
+
+    def units(self):
+        """Get the (xml_hash, xslt_hash) each unit was last built from."""
+        return {
+            unit: (xml_hash, xslt_hash)
+            for unit, xml_hash, xslt_hash in self.conn.execute(
+                "SELECT unit, xml_hash, xslt_hash FROM build_units WHERE outdir=?",
+                (self.outdir,),
+            )
+        }
+
+    def files(self):
+        """Get the files each unit generated, as a dict of unit -> {path: content_hash}.
+           Paths are relative to the output directory."""
+        files = {}
+        for unit, path, _hash in self.conn.execute(
+            "SELECT unit, path, content_hash FROM build_files WHERE outdir=?",
+            (self.outdir,),
+        ):
+            files.setdefault(unit, {})[path] = _hash
+        return files
+
+    def record(self, unit, xml_hash, xslt_hash, files):
+        """Record a unit as built, along with the {path: content_hash} of the files it generated."""
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM build_files WHERE outdir=? AND unit=?", (self.outdir, unit)
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO build_units VALUES (?, ?, ?, ?)",
+                (self.outdir, unit, xml_hash, xslt_hash),
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO build_files VALUES (?, ?, ?, ?)",
+                [(self.outdir, path, unit, _hash) for path, _hash in files.items()],
+            )
+
+    def forget(self, unit):
+        """Remove a unit from the manifest."""
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM build_files WHERE outdir=? AND unit=?", (self.outdir, unit)
+            )
+            self.conn.execute(
+                "DELETE FROM build_units WHERE outdir=? AND unit=?", (self.outdir, unit)
+            )
+
+    def clear(self):
+        """Remove everything recorded for the output directory."""
+        with self.conn:
+            self.conn.execute("DELETE FROM build_files WHERE outdir=?", (self.outdir,))
+            self.conn.execute("DELETE FROM build_units WHERE outdir=?", (self.outdir,))
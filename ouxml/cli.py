@@ -1,11 +1,10 @@
 import click
 import os
-import pandas as pd
-from sqlite_utils import Database
 import shutil
-import ouxml.moodlescraper as mscpr
-import ouxml.OU_XML2md_Converter as ouxml2md
-import ouxml.md_tools as mdtools
+
+# The scraper, converter and their dependencies (pandas, sqlite_utils,
+# mechanicalsoup, ...) are slow to import, so each command only imports
+# what it needs when it runs, which keeps --help and the light commands quick.
 
 def droptable(conn, table):
     cursor = conn.cursor()
@@ -20,21 +19,109 @@ def droptable(conn, table):
     help="SQLite database name (default: openlearn_oer.db)",
 )
 @click.option("--newdb/--no-newdb", default=True)
+@click.option(
+    "--concurrency", default=4, type=int, help="Maximum concurrent requests (default: 4)"
+)
+@click.option(
+    "--rate", default=5.0, type=float, help="Maximum requests per second per host (default: 5)"
+)
+@click.option(
+    "--cache-dir",
+    default=".ouxml_cache",
+    help="HTTP response cache directory; empty to disable (default: .ouxml_cache)",
+)
+@click.option(
+    "--cache-size", default=1024, type=int, help="Maximum cache size in MB (default: 1024)"
+)
+@click.option(
+    "--offline/--online",
+    default=False,
+    help="Only use cached responses and never touch the network.",
+)
+@click.option(
+    "--incremental/--no-incremental",
+    default=False,
+    help="Keep the database and skip figures and images for units whose OU-XML is unchanged.",
+)
 @click.argument("url")
-def get_xml(dbname, newdb, url):
+def get_xml(dbname, newdb, concurrency, rate, cache_dir, cache_size, offline, incremental, url):
     """Get OU-XML for an OpenLearn Unit from OpenLearn HTML URL."""
     # test='https://www.open.edu/openlearn/science-maths-technology/chemistry/the-molecular-world/content-section-1.1'
+    import ouxml.moodlescraper as mscpr
+    import ouxml.fetcher as fetcher
+    import ouxml.httpcache as httpcache
+
+    cache = httpcache.ResponseCache(cache_dir, cache_size * 1024 * 1024) if cache_dir else None
+    fetcher.configure_fetcher(
+        concurrency=concurrency, rate=rate, cache=cache, offline=offline
+    )
     mscpr.scrape_unit_openlearn_base(
-        possible_sc_links=[url], dbname=dbname, newdb=newdb
+        possible_sc_links=[url],
+        dbname=dbname,
+        # There's nothing to compare against in a new database
+        newdb=newdb and not incremental,
+        incremental=incremental,
     )
 
 
+@click.command()
+@click.option(
+    "--dbname",
+    default="openlearn_oer.db",
+    help="SQLite database name (default: openlearn_oer.db)",
+)
+@click.option(
+    "--term", default="", help="Only harvest units whose names match the term."
+)
+@click.option(
+    "--concurrency", default=4, type=int, help="Maximum concurrent requests (default: 4)"
+)
+@click.option(
+    "--rate", default=5.0, type=float, help="Maximum requests per second per host (default: 5)"
+)
+@click.option(
+    "--cache-dir",
+    default=".ouxml_cache",
+    help="HTTP response cache directory; empty to disable (default: .ouxml_cache)",
+)
+@click.option(
+    "--cache-size", default=1024, type=int, help="Maximum cache size in MB (default: 1024)"
+)
+@click.option(
+    "--offline/--online",
+    default=False,
+    help="Only use cached responses and never touch the network.",
+)
+@click.option(
+    "--refresh/--resume",
+    default=False,
+    help="Harvest every unit again rather than resuming the last harvest (default: resume).",
+)
+@click.option(
+    "--max-attempts", default=3, type=int, help="Give up on a unit after this many failures (default: 3)"
+)
+def harvest(dbname, term, concurrency, rate, cache_dir, cache_size, offline, refresh, max_attempts):
+    """Harvest all the OpenLearn units, optionally filtered by term, into one database."""
+    import ouxml.moodlescraper as mscpr
+    import ouxml.fetcher as fetcher
+    import ouxml.httpcache as httpcache
+
+    cache = httpcache.ResponseCache(cache_dir, cache_size * 1024 * 1024) if cache_dir else None
+    fetcher.configure_fetcher(
+        concurrency=concurrency, rate=rate, cache=cache, offline=offline
+    )
+    units = mscpr.getUnitLocations(term)
+    mscpr.harvest_units(units, dbname=dbname, refresh=refresh, max_attempts=max_attempts)
+
+
 @click.command()
 @click.option(
     "--term", default="", help="Get unit listing, optionally filtered by term."
 )
 def get_units(term):
     """Get unit listing, optionally filtered by term."""
+    import ouxml.moodlescraper as mscpr
+
     units = mscpr.getUnitLocations(term)
     for unit in units:
         print(unit["name"], unit["url"])
@@ -47,15 +134,68 @@ def get_units(term):
     help="SQLite database name (default: openlearn_oer.db)",
 )
 @click.option(
-    "--term", default="", help="Get unit listing, optionally filtered by term."
+    "--term", default="", help="Only list units with item or course titles matching the term."
 )
 def get_db_units(dbname, term):
-    """List available units in database."""
-    df = pd.read_sql(
-        f'SELECT * FROM htmlxml WHERE LOWER(itemTitle) LIKE "%{term.lower()}%"', DB.conn
-    )
+    """List available units in database, best matches for the term first."""
+    import sqlite3
+    from ouxml.units import search_units
+
+    conn = sqlite3.connect(dbname)
     print()
-    df.apply(lambda x: print(x["courseCode"], x["itemTitle"]), axis=1)
+    for unit in search_units(conn, term):
+        print(unit["courseCode"], unit["itemTitle"])
+    conn.close()
+
+@click.command()
+@click.option(
+    "--dbname",
+    default="openlearn_oer.db",
+    help="SQLite database name (default: openlearn_oer.db)",
+)
+@click.option(
+    "--rebuild/--update",
+    default=False,
+    help="Index every unit again rather than just the units that changed (default: update).",
+)
+def index_sections(dbname, rebuild):
+    """Build or update the full text index of unit sessions and sections."""
+    import sqlite3
+    from ouxml.sectionindex import update_section_index
+
+    conn = sqlite3.connect(dbname, timeout=10)
+    counts = update_section_index(conn, rebuild=rebuild)
+    conn.close()
+    print(
+        "Indexed {indexed} units, {unchanged} unchanged, {removed} removed".format(**counts)
+    )
+
+
+@click.command()
+@click.option(
+    "--dbname",
+    default="openlearn_oer.db",
+    help="SQLite database name (default: openlearn_oer.db)",
+)
+@click.option("--limit", default=20, type=int, help="Maximum number of hits (default: 20)")
+@click.argument("term")
+def search_sections(dbname, limit, term):
+    """Search the indexed unit sessions and sections, best matches first."""
+    import sqlite3
+    from ouxml.sectionindex import search_sections
+
+    conn = sqlite3.connect(dbname)
+    try:
+        hits = search_sections(conn, term, limit=limit)
+    except sqlite3.OperationalError:
+        print("The database has no section index; build it with: ouxml_index --dbname {}".format(dbname))
+        return
+    finally:
+        conn.close()
+    for hit in hits:
+        print("{} | {}".format(hit["unit"], hit["path"]))
+        print("    {}".format(hit["snippet"]))
+        print("    {}".format(hit["html_url"]))
 
 @click.command()
 @click.argument('path', default='.', type=click.Path(exists=True))
@@ -63,14 +203,36 @@ def get_db_units(dbname, term):
 @click.option('--out_path', '-o', default='md_out',  help='Out path stub')
 def xmlfile2md(path, xslt, out_path):
 	"""Convert XML file to markdown files."""
+	import ouxml.OU_XML2md_Converter as ouxml2md
+
 	click.echo('Using XML file: {}'.format(path))
 	ouxml2md.transform_xml2md(path, xslt=xslt, output_path_stub=out_path)
 
+@click.command()
+@click.argument("dbname", type=click.Path(exists=True))
+def migrate_db(dbname):
+    """Migrate a database to the current storage format."""
+    import ouxml.moodlescraper as mscpr
+
+    DB = mscpr.setup_DB(dbname)
+    mscpr.migrate_schema(DB)
+    mscpr.migrate_imagetest_hashed(DB)
+
 @click.command()
 @click.argument('path', default='.', type=click.Path(exists=True))
-def clean_md(path):
+@click.option(
+    "--jobs", "-j", default=1, type=int, help="Number of worker processes (default: 1)"
+)
+@click.option(
+    "--incremental/--no-incremental",
+    default=False,
+    help="Skip files that are unchanged since they were last cleaned.",
+)
+def clean_md(path, jobs, incremental):
     """Clean markdown files."""
-    mdtools.clean_md(path)
+    import ouxml.md_tools as mdtools
+
+    mdtools.clean_md(path, jobs=jobs, incremental=incremental)
 
 @click.command()
 @click.option(
@@ -84,28 +246,40 @@ def clean_md(path):
     help="Markdown file output directory (default: oer_md)",
 )
 @click.option("--prefix", default="Part", help="Filename prefix (default: Part)")
-def ouxml2md_conversion(dbname, outdir, prefix):
+@click.option(
+    "--jobs", "-j", default=1, type=int, help="Number of worker processes (default: 1)"
+)
+@click.option(
+    "--clean/--no-clean",
+    default=False,
+    help="Tidy up the generated markdown as ouxmlcleanmd does (default: no-clean)",
+)
+@click.option(
+    "--timings/--no-timings", default=False, help="Report time spent in each rewriting stage."
+)
+@click.option(
+    "--incremental/--no-incremental",
+    default=False,
+    help="Only reconvert units that changed since the last build into outdir.",
+)
+def ouxml2md_conversion(dbname, outdir, prefix, jobs, clean, timings, incremental):
     """Convert item(s) in database to markdown.
-       Note that this clobbers the directory we write into.
+       Note that this clobbers the directory we write into,
+       unless --incremental is set.
     """
+    import ouxml.OU_XML2md_Converter as ouxml2md
 
-    def hackfornow(row, col="itemTitle", outdir="content"):
-        """Need to do this all properly, eg where lots of units in db..."""
-        ouxml2md.transformer(DB.conn, col, row[col], outdir)
-
-    outpath = os.path.join(outdir, prefix)
-    
-    if os.path.exists(outdir) and os.path.isdir(outdir):
+    if not incremental and os.path.exists(outdir) and os.path.isdir(outdir):
         print(f"Deleting previous {outdir} directory.")
         shutil.rmtree(outdir)
 
     print(f"Rendering files into dir: {outdir}")
-    DB = Database(dbname)
-    pages = pd.read_sql("SELECT * FROM htmlxml", DB.conn)
-    pages.apply(hackfornow, outdir=outpath, axis=1)
-    ouxml2md.openlearn_image_mapper(dbname, outdir, "images")
-    ouxml2md.split_into_subdirs(outdir)
-    _toc = ouxml2md.create_minimal_toc_from_dir(path=outdir, DB=DB)
+    pipeline = ouxml2md.convert_units(
+        dbname, outdir, prefix=prefix, jobs=jobs, clean=clean, incremental=incremental
+    )
+    if timings:
+        pipeline.report()
+    _toc = ouxml2md.create_minimal_toc_from_dir(path=outdir, dbname=dbname)
     print(f"Generating table of contents file as: index.rst")
-    with open('index.rst', 'w') as f:
-        f.write(_toc)
\ No newline at end of file
+    # Leave the file untouched if it hasn't changed
+    ouxml2md.write_files({"index.rst": _toc}, only_changed=True)
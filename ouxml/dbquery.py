@@ -0,0 +1,30 @@
+# dbquery.py
+
+# A thin layer over sqlite3 cursors for reading from the scrape database.
+# Queries should only select the columns they need, and rows are streamed
+# from the cursor as dicts rather than loaded into a DataFrame, so that
+# looking something up doesn't mean reading every stored document.
+
+
+def connection(db):
+    """Get the sqlite3 connection for a sqlite_utils Database or a sqlite3 connection."""
+    return getattr(db, "conn", db)
+
+
+def query_rows(conn, sql, params=()):
+    """Yield each row of a query as a dict of column -> value."""
+    cursor = connection(conn).execute(sql, params)
+    cols = [c[0] for c in cursor.description]
+    for row in cursor:
+        yield dict(zip(cols, row))
+
+
+def query_row(conn, sql, params=()):
+    """Get the first row of a query as a dict, or None if there are no rows."""
+    return next(query_rows(conn, sql, params), None)
+
+
+def query_value(conn, sql, params=()):
+    """Get the first column of the first row of a query, or None if there are no rows."""
+    row = connection(conn).execute(sql, params).fetchone()
+    return None if row is None else row[0]
@@ -0,0 +1,115 @@
+# dbwriter.py
+
+# Buffered database writes for the scrapers.
+# Rows for the scrape tables are collected in memory and written in
+# a single transaction, rather than each insert committing on its own,
+# and everything written for a unit either lands together or not at all.
+
+from contextlib import contextmanager
+
+
+class BatchWriter:
+    """Buffer rows for several tables and flush them in one transaction."""
+
+    def __init__(self, db, batch_size=500):
+        self.db = db
+        self.batch_size = batch_size
+        # (table, conflict) -> list of row dicts, in the order tables were first used
+        self.pending = {}
+        # (table, column, value) for rows to delete before the queued rows are written
+        self.deletes = []
+        self._units = 0
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.pending.values())
+
+    def add(self, table, row, conflict=""):
+        """Queue a row for a table; `conflict` may be eg "OR IGNORE" or "OR REPLACE"."""
+        self.pending.setdefault((table, conflict), []).append(dict(row))
+        if not self._units and len(self) >= self.batch_size:
+            self.flush()
+
+    def add_all(self, table, rows, conflict=""):
+        """Queue several rows for a table."""
+        for row in rows:
+            self.add(table, row, conflict)
+
+    def delete(self, table, column, value):
+        """Queue the deletion of the rows of a table where column is value,
+           eg to replace the rows for a page; any rows already queued for it
+           are dropped, and the deletion is written before the queued rows."""
+        self.deletes.append((table, column, value))
+        for (_table, conflict), rows in self.pending.items():
+            if _table == table:
+                rows[:] = [row for row in rows if row.get(column) != value]
+
+    def _prepare(self, table, rows):
+        """Make sure the table exists and has a column for every key in rows."""
+        # Importing sqlite_utils is slow, and self.db means it is already loaded
+        from sqlite_utils.utils import suggest_column_types
+
+        if not self.db[table].exists():
+            self.db[table].create(suggest_column_types(rows))
+        else:
+            self.db[table].add_missing_columns(rows)
+
+    def flush(self):
+        """Write all the queued rows in a single transaction."""
+        if not self.pending and not self.deletes:
+            return
+        pending, self.pending = self.pending, {}
+        deletes, self.deletes = self.deletes, []
+        for (table, conflict), rows in pending.items():
+            self._prepare(table, rows)
+        conn = self.db.conn
+        with conn:
+            for table, column, value in deletes:
+                if self.db[table].exists():
+                    conn.execute("DELETE FROM [{}] WHERE [{}]=?".format(table, column), (value,))
+            for (table, conflict), rows in pending.items():
+                # Rows for the same table may not all have the same keys
+                groups = {}
+                for row in rows:
+                    groups.setdefault(tuple(row), []).append(row)
+                for cols, _rows in groups.items():
+                    sql = "INSERT {} INTO [{}] ({}) VALUES ({})".format(
+                        conflict,
+                        table,
+                        ", ".join("[{}]".format(c) for c in cols),
+                        ", ".join("?" * len(cols)),
+                    )
+                    for i in range(0, len(_rows), self.batch_size):
+                        conn.executemany(
+                            sql, [tuple(r[c] for c in cols) for r in _rows[i : i + self.batch_size]]
+                        )
+
+    def discard(self):
+        """Drop any queued rows without writing them."""
+        self.pending = {}
+        self.deletes = []
+
+    @contextmanager
+    def unit(self):
+        """Write everything queued within the block atomically when it exits.
+           Nested blocks are written when the outermost block exits; if a
+           block raises an exception, nothing queued within it is written."""
+        if not self._units:
+            self.flush()
+        # Note where we are, so we can drop just this block's rows
+        mark = {key: len(rows) for key, rows in self.pending.items()}
+        deletes_mark = len(self.deletes)
+        self._units = self._units + 1
+        try:
+            yield self
+        except BaseException:
+            self._units = self._units - 1
+            for key in list(self.pending):
+                if key in mark:
+                    del self.pending[key][mark[key] :]
+                else:
+                    del self.pending[key]
+            del self.deletes[deletes_mark:]
+            raise
+        self._units = self._units - 1
+        if not self._units:
+            self.flush()
@@ -0,0 +1,55 @@
+# document.py
+
+# A fetched or stored OU-XML document that is decoded and parsed at most once,
+# however many stages of the scrape and conversion pipeline look at it.
+
+import hashlib
+
+from lxml import etree
+
+
+class OUXMLDocument:
+    """OU-XML document wrapping the raw bytes, decoded text and parsed tree."""
+
+    def __init__(self, raw=None, text=None, root=None):
+        self._raw = raw
+        self._text = text
+        self._root = root
+        self._hash = None
+
+    @property
+    def raw(self):
+        """The document as UTF-8 encoded bytes."""
+        if self._raw is None and self._text is not None:
+            self._raw = self._text.encode("utf-8")
+        return self._raw
+
+    @property
+    def text(self):
+        """The document as a string; raises UnicodeDecodeError if it isn't UTF-8."""
+        if self._text is None and self._raw is not None:
+            self._text = self._raw.decode("utf-8")
+        return self._text
+
+    @property
+    def hash(self):
+        """SHA-256 hash of the document bytes, for spotting changed documents."""
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.raw).hexdigest()
+        return self._hash
+
+    @property
+    def root(self):
+        """The parsed document root element."""
+        if self._root is None:
+            self._root = etree.fromstring(self.raw)
+        return self._root
+
+    @property
+    def doctype(self):
+        """Whether this looks like an XML or an HTML document."""
+        if self.raw.startswith(b"<?xml"):
+            return "XML"
+        elif self.raw.startswith(b"<!DOCTYPE html"):
+            return "HTML"
+        return None
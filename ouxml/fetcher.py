@@ -0,0 +1,160 @@
+# fetcher.py
+
+# Concurrent, rate limited HTTP fetching for the scrapers.
+# Requests to the same host are throttled by a token bucket rather than
+# a fixed sleep, so that we can have several requests in flight at once
+# without hammering any one server.
+# If a response cache is provided, cached responses are revalidated with
+# conditional GETs, and in offline mode are served without any network access.
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Token bucket rate limiter: `rate` requests a second, bursts of up to `burst`."""
+
+    def __init__(self, rate=5.0, burst=5):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Fetcher:
+    """Fetch URLs over pooled connections with per-host rate limiting and retries."""
+
+    def __init__(
+        self,
+        concurrency=4,
+        rate=5.0,
+        burst=5,
+        retries=3,
+        backoff=0.5,
+        timeout=60,
+        cache=None,
+        offline=False,
+    ):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.offline = offline
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        # Bounds the requests in flight across every caller, however many
+        # threads they fetch from
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._pool = None
+
+    def _bucket(self, url):
+        """Get the rate limiter for the host a URL points to."""
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+            return self._buckets[host]
+
+    def _session(self, s=None):
+        """Use the session wrapped by a browser object, a provided session, or our own."""
+        if not s or isinstance(s, str):
+            return self.session
+        # mechanicalsoup browsers wrap a requests session
+        return getattr(s, "session", s)
+
+    def get(self, url, s=None):
+        """Fetch a URL, retrying with exponential backoff on errors.
+           Returns the response, or None if we never got one, or the server was
+           still returning a retryable error status when we ran out of retries.
+           Other error statuses are returned, so callers should check r.ok."""
+        if not url:
+            return None
+        entry = self.cache.lookup(url) if self.cache is not None else None
+        if self.offline:
+            return self.cache.response(entry) if entry else None
+        headers = self.cache.conditional_headers(entry) if entry else {}
+        session = self._session(s)
+        r = None
+        for attempt in range(self.retries + 1):
+            self._bucket(url).acquire()
+            try:
+                with self._slots:
+                    r = session.get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException:
+                r = None
+            if r is not None and r.status_code not in RETRY_STATUS:
+                if self.cache is not None:
+                    if r.status_code == 304 and entry:
+                        cached = self.cache.response(entry)
+                        # If the body was evicted meanwhile, the lookup misses this time
+                        return cached if cached is not None else self.get(url, s)
+                    if r.status_code == 200:
+                        self.cache.store(url, r)
+                return r
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2**attempt * random.uniform(1, 1.5))
+        # Don't pass error pages off as content
+        return None
+
+    def get_all(self, urls, s=None):
+        """Fetch several URLs concurrently; responses are returned in the order of `urls`."""
+        urls = list(urls)
+        if len(urls) < 2 or self.concurrency < 2:
+            return [self.get(url, s) for url in urls]
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        return list(self._pool.map(lambda url: self.get(url, s), urls))
+
+
+# A process wide fetcher shared by the scrapers
+_FETCHER = None
+
+
+def get_fetcher():
+    """Return the shared fetcher, creating it if required."""
+    global _FETCHER
+    if _FETCHER is None:
+        _FETCHER = Fetcher()
+    return _FETCHER
+
+
+def configure_fetcher(**kwargs):
+    """Replace the shared fetcher with one using the given settings."""
+    global _FETCHER
+    _FETCHER = Fetcher(**kwargs)
+    return _FETCHER
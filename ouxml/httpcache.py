@@ -0,0 +1,256 @@
+# httpcache.py
+
+# On-disk HTTP response cache for the scrapers.
+# Response bodies are stored as files named by their SHA-256 hash and
+# indexed by URL in a small SQLite database along with the validators
+# (ETag, Last-Modified) we need to revalidate them with a conditional GET.
+# The total size of the bodies is kept in memory, and access times are
+# written in batches, so that cache hits don't each cost a commit.
+
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+
+create_responses = '''
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    final_url TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    content_type TEXT,
+    contenthash TEXT,
+    size INTEGER,
+    fetched REAL,
+    accessed REAL
+);
+'''
+
+create_indexes = [
+    "CREATE INDEX IF NOT EXISTS idx_responses_contenthash ON responses (contenthash)",
+    "CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed)",
+]
+
+# Write changes to the index after this many stores or hits
+COMMIT_EVERY = 100
+
+
+# Hosts whose pages are the same for everyone, so responses from them can be
+# cached even if the request carried a session cookie, as OpenLearn ones do
+PUBLIC_HOSTS = {"www.open.edu", "openlearn.open.ac.uk"}
+
+
+def cacheable(r):
+    """Whether a response may be kept in a shared cache: not if the server
+       says it mustn't be, or if it was fetched with credentials, such as
+       a logged in VLE session, from a host that isn't one of PUBLIC_HOSTS.
+       Entries are keyed by URL alone, so they mustn't depend on who asked."""
+    cache_control = r.headers.get("Cache-Control", "").lower()
+    if "no-store" in cache_control or "private" in cache_control:
+        return False
+    request = getattr(r, "request", None)
+    if request is None:
+        return True
+    if "Authorization" in request.headers:
+        return False
+    return "Cookie" not in request.headers or urlsplit(request.url).hostname in PUBLIC_HOSTS
+
+
+class ResponseCache:
+    """Size bounded, least recently used cache of HTTP responses on disk."""
+
+    def __init__(self, path=".ouxml_cache", max_bytes=1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(path, "bodies"), exist_ok=True)
+        self.conn = sqlite3.connect(
+            os.path.join(path, "index.db"), timeout=10, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(create_responses)
+        for index in create_indexes:
+            self.conn.execute(index)
+        self.conn.commit()
+        self.lock = threading.Lock()
+        # Bodies may be shared by several URLs, so count each one once
+        self.total = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT contenthash, size FROM responses)"
+        ).fetchone()[0]
+        # url -> access time, for hits not yet written to the index
+        self._accessed = {}
+        self._changes = 0
+        atexit.register(self.flush)
+
+    def _body_path(self, contenthash):
+        return os.path.join(self.path, "bodies", contenthash)
+
+    def _shared(self, contenthash):
+        return self.conn.execute(
+            "SELECT 1 FROM responses WHERE contenthash=? LIMIT 1", (contenthash,)
+        ).fetchone()
+
+    def _remove_body(self, contenthash, size):
+        """Remove a body nothing refers to any more; call with the lock held."""
+        if self._shared(contenthash):
+            return
+        self.total -= size or 0
+        try:
+            os.remove(self._body_path(contenthash))
+        except OSError:
+            pass
+
+    def _write_accessed(self):
+        if self._accessed:
+            self.conn.executemany(
+                "UPDATE responses SET accessed=? WHERE url=?",
+                [(accessed, url) for url, accessed in self._accessed.items()],
+            )
+            self._accessed = {}
+
+    def _changed(self):
+        """Count a change to the index, committing every COMMIT_EVERY changes;
+           call with the lock held."""
+        self._changes += 1
+        if self._changes >= COMMIT_EVERY:
+            self._write_accessed()
+            self.conn.commit()
+            self._changes = 0
+
+    def flush(self):
+        """Write any pending access times and changes to the index."""
+        with self.lock:
+            self._write_accessed()
+            self.conn.commit()
+            self._changes = 0
+
+    def lookup(self, url):
+        """Get the cache entry for a URL as a dict, or None."""
+        with self.lock:
+            cursor = self.conn.execute("SELECT * FROM responses WHERE url=?", (url,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            entry = dict(zip([c[0] for c in cursor.description], row))
+        if not os.path.isfile(self._body_path(entry["contenthash"])):
+            return None
+        return entry
+
+    def conditional_headers(self, entry):
+        """Request headers to revalidate a cache entry."""
+        headers = {}
+        if entry is None:
+            return headers
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def response(self, entry):
+        """Build a response object from a cache entry, or return None if its
+           body has been evicted since the entry was looked up."""
+        try:
+            with open(self._body_path(entry["contenthash"]), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self._accessed[entry["url"]] = time.time()
+            self._changed()
+        r = requests.Response()
+        r._content = content
+        r.status_code = 200
+        r.url = entry["final_url"] or entry["url"]
+        r.encoding = "utf-8"
+        if entry["content_type"]:
+            r.headers["Content-Type"] = entry["content_type"]
+        if entry["etag"]:
+            r.headers["ETag"] = entry["etag"]
+        if entry["last_modified"]:
+            r.headers["Last-Modified"] = entry["last_modified"]
+        r.from_cache = True
+        return r
+
+    def store(self, url, r):
+        """Save a successful response in the cache, unless it isn't cacheable()."""
+        if not cacheable(r):
+            return
+        content = r.content
+        contenthash = hashlib.sha256(content).hexdigest()
+        body_path = self._body_path(contenthash)
+        if not os.path.isfile(body_path):
+            tmp_path = "{}.{}.tmp".format(body_path, threading.get_ident())
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, body_path)
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute(
+                "SELECT contenthash, size FROM responses WHERE url=?", (url,)
+            ).fetchone()
+            if not self._shared(contenthash):
+                self.total += len(content)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    r.url,
+                    r.headers.get("ETag"),
+                    r.headers.get("Last-Modified"),
+                    r.headers.get("Content-Type"),
+                    contenthash,
+                    len(content),
+                    now,
+                    now,
+                ),
+            )
+            self._accessed.pop(url, None)
+            if old and old[0] != contenthash:
+                self._remove_body(*old)
+            self._changed()
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        with self.lock:
+            if self.total <= self.max_bytes:
+                return
+            self._write_accessed()
+            cursor = self.conn.execute(
+                "SELECT url, contenthash, size FROM responses ORDER BY accessed"
+            )
+            while self.total > self.max_bytes:
+                rows = cursor.fetchmany(100)
+                if not rows:
+                    break
+                for url, contenthash, size in rows:
+                    self.conn.execute("DELETE FROM responses WHERE url=?", (url,))
+                    self._remove_body(contenthash, size)
+                    if self.total <= self.max_bytes:
+                        break
+            self.conn.commit()
+            self._changes = 0
+
+    def clear(self):
+        """Empty the cache."""
+        with self.lock:
+            for (contenthash,) in self.conn.execute(
+                "SELECT DISTINCT contenthash FROM responses"
+            ).fetchall():
+                try:
+                    os.remove(self._body_path(contenthash))
+                except OSError:
+                    pass
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+            self.total = 0
+            self._accessed = {}
+            self._changes = 0
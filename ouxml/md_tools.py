@@ -1,21 +1,108 @@
 import os
 import re
+import json
+import hashlib
 
-def clean_md(_path):
-    """Clean generated markdown files."""
+# Runs of 4 or more - or _, with any whitespace around them, become a rule
+_RULE_RE = re.compile(r'\s*[-_]{4,}\s*')
+# Consecutive rules are collapsed into one
+_RULES_RE = re.compile(r'(\s*-{3,}\s*){2,}')
+# The patterns above try a match at every whitespace character, so only
+# run them over text that contains something they might change
+_RULE_HINT_RE = re.compile(r'[-_]{4}')
+_RULES_HINT_RE = re.compile(r'-{3}\s*-{3}')
+
+# Content hashes of cleaned files are kept in this file at the top of the tree
+CLEAN_MD_MANIFEST = ".clean_md.json"
+# Bump this if clean_md_text changes, so that files get cleaned again
+CLEAN_MD_VERSION = 1
+
+
+def clean_md_text(content):
+    """Clean the text of a generated markdown file."""
+    if _RULE_HINT_RE.search(content):
+        content = _RULE_RE.sub('\n\n---\n\n', content)
+    if _RULES_HINT_RE.search(content):
+        content = _RULES_RE.sub('\n\n---\n\n', content)
+    # Strip trailing whitespace and - from the end of the file
+    while True:
+        stripped_content = content.rstrip().rstrip('-')
+        if stripped_content == content:
+            break
+        content = stripped_content
+    return f"{stripped_content}\n"
+
+
+def _content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def _clean_md_file(file_path):
+    """Clean a markdown file, only writing it if it changes.
+       Returns whether it changed and the hash of the cleaned content."""
+    with open(file_path, 'r') as file:
+        content = file.read()
+    cleaned = clean_md_text(content)
+    if cleaned != content:
+        with open(file_path, 'w') as file:
+            file.write(cleaned)
+    return cleaned != content, _content_hash(cleaned)
+
+
+def _read_clean_md_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != CLEAN_MD_VERSION:
+        return {}
+    return manifest.get("files", {})
+
+
+def clean_md(_path, jobs=1, incremental=False):
+    """Clean generated markdown files.
+       With jobs > 1, files are cleaned in a process pool.
+       With incremental, the content hash of each cleaned file is recorded,
+       and files that haven't changed since are skipped on later runs."""
     # TO DO  - properly lint, health check and clean files
+    file_paths = []
     for folder, _, files in os.walk(_path):
         for file in files:
             if file.endswith(".md"):
-                file_path = os.path.join(folder, file)
-                print(f"Processing {file_path}")
-
-                with open(file_path, 'r') as file:
-                    content = file.read()
-                
-                # Strip trailing whitespace and - from the end of the file
-                stripped_content = re.sub(r'([\s\n]*[-_]{4,}[\s\n]*)', '\n\n---\n\n', content)
-                stripped_content = re.sub(r'([\s\n]*-{3,}[\s\n]*){2,}', '\n\n---\n\n', stripped_content)
-                stripped_content = re.sub(r'[-\s\r\n]+$', '', stripped_content)
-                with open(file_path, 'w') as file:
-                    file.write(f"{stripped_content}\n")
\ No newline at end of file
+                file_paths.append(os.path.join(folder, file))
+
+    manifest_path = os.path.join(_path, CLEAN_MD_MANIFEST)
+    hashes = _read_clean_md_manifest(manifest_path) if incremental else {}
+    todo = []
+    for file_path in file_paths:
+        key = os.path.relpath(file_path, _path)
+        if key in hashes:
+            with open(file_path, 'r') as f:
+                if _content_hash(f.read()) == hashes[key]:
+                    continue
+        todo.append(file_path)
+    if incremental:
+        print(f"Skipping {len(file_paths) - len(todo)} unchanged files")
+
+    if jobs is None or jobs <= 1:
+        results = map(_clean_md_file, todo)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        results = pool.map(_clean_md_file, todo, chunksize=16)
+    try:
+        for file_path, (changed, content_hash) in zip(todo, results):
+            print(f"Processing {file_path}" + ("" if changed else " (unchanged)"))
+            hashes[os.path.relpath(file_path, _path)] = content_hash
+    finally:
+        if jobs is not None and jobs > 1:
+            pool.shutdown()
+
+    if incremental:
+        # Forget files that have gone away
+        keep = {os.path.relpath(file_path, _path) for file_path in file_paths}
+        hashes = {key: value for key, value in hashes.items() if key in keep}
+        with open(manifest_path, 'w') as f:
+            json.dump({"version": CLEAN_MD_VERSION, "files": hashes}, f, indent=1, sort_keys=True)
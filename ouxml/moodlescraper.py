@@ -17,29 +17,33 @@
 
 # Routines for scraping content from OU Moodle VLE and OpenLearn sites
 
-import time
-import random
-import requests
-import mechanicalsoup
-from bs4 import BeautifulSoup
 from lxml import etree
 import unicodedata
 import base64
+import hashlib
+import io
 import os
+import time
 import urllib.parse
 
-
-import pandas as pd
-
-from sqlite_utils import Database
+# mechanicalsoup, BeautifulSoup, pandas and sqlite_utils are slow to import,
+# so they are imported in the functions that use them.
 
 
 # Need to package this...
 from ouxml.vlescrapertools import get_possible_sc_links
+from ouxml.fetcher import get_fetcher
+from ouxml.document import OUXMLDocument
+from ouxml.dbwriter import BatchWriter
+from ouxml.units import create_unit_index
+from ouxml.sectionindex import create_section_index, index_unit
 
 
 # Need to do this a better way; hack for now
 DB = None
+# Scrape results are buffered and written to DB in batches
+WRITER = None
+WRITE_BATCH_SIZE = 500
 
 
 # Utils
@@ -50,11 +54,25 @@ def flatten(el):
     """Utility function for flattening XML tags."""
     if el is None:
         return ""  # Originally returned None; any side effects of move to ''?
-    result = [(el.text or "")]
-    for sel in el:
-        result.append(flatten(sel))
-        result.append(sel.tail or "")
-    return unicodedata.normalize("NFKD", "".join(result)) or " "
+    # Walk the tree with a stack of elements and tails still to visit, rather
+    # than recursing, and only normalise the text once at the end.
+    # An empty element with no children flattens to a single space.
+    if not len(el):
+        return unicodedata.normalize("NFKD", el.text or " ")
+    result = []
+    stack = [el]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            result.append(item)
+        elif len(item):
+            result.append(item.text or "")
+            for sel in reversed(item):
+                stack.append(sel.tail or "")
+                stack.append(sel)
+        else:
+            result.append(item.text or " ")
+    return unicodedata.normalize("NFKD", "".join(result))
 
 
 # We use a session just to simplify things wrt VLE scraper
@@ -62,6 +80,8 @@ def flatten(el):
 def getSession():
     """Create a connection session to OpenLearn."""
 
+    import mechanicalsoup
+
     URL = "https://www.open.edu/openlearn/"
 
     browser = mechanicalsoup.StatefulBrowser()
@@ -78,33 +98,44 @@ def _get_page(url, s=None):
     if not url:
         # What's a proper null requests object?
         return None
-    # Play nice
-    time.sleep(random.uniform(0.1, 0.3))
-    if not s or isinstance(s, str):
-        r = requests.get(url)
-    else:
-        # should check this is a valid session
-        try:
-            r = s.open(url)
-        except:
-            return None
-    return r
+    # Play nice: the fetcher rate limits requests to each host
+    return get_fetcher().get(url, s)
+
+
+def _get_pages(urls, s=None):
+    """Fetch several pages concurrently, playing nice with each host."""
+    return get_fetcher().get_all(urls, s)
+
+
+def _response_error(r):
+    """Say why a fetch didn't get us a page, or return None if it did."""
+    if r is None:
+        return "No response, or an error status that persisted through retries"
+    if not r.ok:
+        return "HTTP {}".format(r.status_code)
+    return None
 
 
 # ===
 
 
 # +
+# Bump this when the schema changes, and add a step to migrate_schema()
+SCHEMA_VERSION = 2
+
 create_htmlxml = '''
 CREATE TABLE IF NOT EXISTS htmlxml (
     possible_sc_link TEXT,
     doctype TEXT,
-    html_url TEXT,
+    html_url TEXT PRIMARY KEY,
     xml TEXT,
     course_presentation TEXT,
     courseCode TEXT,
     courseTitle TEXT,
-    itemTitle TEXT
+    itemTitle TEXT,
+    xml_hash TEXT,
+    fetched REAL,
+    changed REAL
 );
 '''
 create_xmlfigures = '''
@@ -123,7 +154,19 @@ CREATE TABLE IF NOT EXISTS xmlfigures (
     imgurl TEXT,
     alt TEXT,
     stub TEXT,
-    minstub TEXT
+    minstub TEXT,
+    xurl TEXT
+);
+'''
+
+create_htmlfigures = '''
+CREATE TABLE IF NOT EXISTS htmlfigures (
+    hurl TEXT,
+    hpageurl TEXT,
+    stub TEXT,
+    coursecode TEXT,
+    minstub TEXT,
+    PRIMARY KEY (hpageurl, stub)
 );
 '''
 
@@ -131,38 +174,273 @@ create_imagetest = '''
 CREATE TABLE IF NOT EXISTS imagetest (
     b64image BLOB,
     stub TEXT,
-    minstub TEXT
+    minstub TEXT,
+    image BLOB,
+    hash TEXT,
+    x_contenthash TEXT,
+    pageurl TEXT,
+    PRIMARY KEY (pageurl, stub)
 );'''
 
+# Content addressed image data, keyed by the SHA-256 hash of the image bytes
+create_imagestore = '''
+CREATE TABLE IF NOT EXISTS imagestore (
+    hash TEXT PRIMARY KEY,
+    image BLOB,
+    size INTEGER
+);'''
+
+# How saveImages stores image data:
+# "hashed" stores each distinct image once in imagestore, with imagetest
+# mapping image stubs onto image hashes,
+# "blob" stores the raw image bytes in the imagetest image column,
+# "base64" stores base64 encoded data in the legacy imagetest b64image column.
+IMAGE_STORAGE = "hashed"
+
+# Rows are keyed so that re-scraping a page replaces what we had for it.
+# Images are keyed by the page they were scraped for as well as their file name,
+# since units often have images with the same name, such as figure1.jpg.
+# xmlfigures isn't keyed: several figures on a page can share an image, or
+# have no image url at all, so a page's figures are deleted and written again.
+SCHEMA_KEYS = {
+    "htmlxml": ["html_url"],
+    "htmlfigures": ["hpageurl", "stub"],
+    "imagetest": ["pageurl", "stub"],
+}
+
+# The image lookups join on stubs and minstubs, and pages are looked up by the link
+# they were scraped from; the unit lookup indexes are made by create_unit_index()
+create_indexes = [
+    "CREATE INDEX IF NOT EXISTS idx_htmlxml_possible_sc_link ON htmlxml (possible_sc_link)",
+    "CREATE INDEX IF NOT EXISTS idx_xmlfigures_xpageurl ON xmlfigures (xpageurl)",
+    "CREATE INDEX IF NOT EXISTS idx_xmlfigures_stub ON xmlfigures (stub)",
+    "CREATE INDEX IF NOT EXISTS idx_xmlfigures_minstub ON xmlfigures (minstub)",
+    "CREATE INDEX IF NOT EXISTS idx_htmlfigures_stub ON htmlfigures (stub)",
+    "CREATE INDEX IF NOT EXISTS idx_htmlfigures_minstub ON htmlfigures (minstub)",
+    "CREATE INDEX IF NOT EXISTS idx_imagetest_minstub ON imagetest (minstub)",
+    "CREATE INDEX IF NOT EXISTS idx_imagetest_x_contenthash ON imagetest (x_contenthash)",
+]
+
 # -
 
-def setup_DB(dbname="test_vle_course_scraper_db.db", newdb=False):
+def setup_DB(dbname="test_vle_course_scraper_db.db", newdb=False, batch_size=None):
     """Create a new database and database connection."""
 
     # Need to find a better way to do this
-    global DB
+    global DB, WRITER
 
     # At the moment this doesn't create a new database
     # if the db already exists we just reuse it.
-    # If we are reusing a database, we should upsert not insert,
-    # but this also means we need to identify primary keys in tables?
+    # Rows are upserted against the SCHEMA_KEYS primary keys, so re-scraping
+    # a page replaces its rows; databases created before the tables had keys
+    # need migrating with migrate_schema() for this to work.
 
     # Should really find a way to require a confirmation for this?
     if newdb and os.path.isfile(dbname):
         print("Deleting old database: {}", dbname)
         os.remove(dbname)
 
+    from sqlite_utils import Database
+
     print("Creating database connection: {}".format(dbname))
     DB = Database(dbname)
-    
+    # We write a lot of small rows; a write ahead log with relaxed syncing
+    # is much quicker and still safe against corrupting the database
+    DB.enable_wal()
+    DB.execute("PRAGMA synchronous=NORMAL")
+    DB.execute("PRAGMA temp_store=MEMORY")
+    DB.execute("PRAGMA cache_size=-65536")
+    WRITER = BatchWriter(DB, batch_size=batch_size or WRITE_BATCH_SIZE)
+
     print('Create tables...')
+    newschema = "htmlxml" not in DB.table_names()
+    unkey_xmlfigures(DB)
     c = DB.conn.cursor()
     c.execute(create_htmlxml)
     c.execute(create_xmlfigures)
+    c.execute(create_htmlfigures)
     c.execute(create_imagetest)
+    c.execute(create_imagestore)
+    # Databases created before raw or hashed image storage need extra columns
+    for col in ["image BLOB", "hash TEXT", "x_contenthash TEXT", "pageurl TEXT"]:
+        if col.split()[0] not in DB["imagetest"].columns_dict:
+            c.execute("ALTER TABLE imagetest ADD COLUMN {}".format(col))
+    if "xurl" not in DB["xmlfigures"].columns_dict:
+        c.execute("ALTER TABLE xmlfigures ADD COLUMN xurl TEXT")
+    # Databases created before incremental scrapes need change tracking columns
+    for col in ["xml_hash TEXT", "fetched REAL", "changed REAL"]:
+        if col.split()[0] not in DB["htmlxml"].columns_dict:
+            c.execute("ALTER TABLE htmlxml ADD COLUMN {}".format(col))
+    for index in create_indexes:
+        c.execute(index)
+    create_unit_index(DB.conn)
+    create_section_index(DB.conn)
+    if newschema:
+        c.execute("PRAGMA user_version={}".format(SCHEMA_VERSION))
+    elif schema_version(DB) < SCHEMA_VERSION:
+        print("Database schema is out of date; migrate it with: ouxml_migrate {}".format(dbname))
     return DB
 
 
+def unkey_xmlfigures(DB):
+    """Rebuild an xmlfigures table that was keyed on (xpageurl, stub) without
+       the key, keeping every row. Figures that shared a key overwrote each other."""
+    if not DB["xmlfigures"].exists() or DB["xmlfigures"].pks == ["rowid"]:
+        return
+    cols = ", ".join(
+        "[{}] {}".format(name, type_)
+        for name, type_ in DB.execute("SELECT name, type FROM pragma_table_info('xmlfigures')")
+    )
+    names = ", ".join("[{}]".format(name) for name in DB["xmlfigures"].columns_dict)
+    with DB.conn:
+        DB.execute("ALTER TABLE xmlfigures RENAME TO _xmlfigures_keyed")
+        DB.execute("CREATE TABLE xmlfigures ({})".format(cols))
+        DB.execute(
+            "INSERT INTO xmlfigures ({names}) SELECT {names} FROM _xmlfigures_keyed ORDER BY rowid".format(
+                names=names
+            )
+        )
+        DB.execute("DROP TABLE _xmlfigures_keyed")
+    print("Removed the primary key from xmlfigures")
+
+
+def schema_version(DB):
+    """Get the schema version of a database."""
+    return DB.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_schema(DB):
+    """Bring the schema of an existing database up to date.
+       Duplicate rows are removed, keeping the most recently scraped,
+       so that the tables can be keyed. Rows with a missing key column can't
+       clash, so they are kept; images scraped before they were keyed by page
+       don't have one."""
+    version = schema_version(DB)
+    # Version 1 keyed the tables, and version 2 keys images by page too
+    if version < 2:
+        for table, pk in SCHEMA_KEYS.items():
+            if not DB[table].exists() or DB[table].pks == pk:
+                continue
+            if not set(pk).issubset(DB[table].columns_dict):
+                print("Can't key {} on {}".format(table, ", ".join(pk)))
+                continue
+            with DB.conn:
+                n = DB.execute(
+                    """DELETE FROM [{table}] WHERE {notnull} AND rowid NOT IN
+                       (SELECT MAX(rowid) FROM [{table}] GROUP BY {keys})""".format(
+                        table=table,
+                        keys=", ".join("[{}]".format(k) for k in pk),
+                        notnull=" AND ".join("[{}] IS NOT NULL".format(k) for k in pk),
+                    )
+                ).rowcount
+            print("Removed {} duplicate rows from {}".format(n, table))
+            DB[table].transform(pk=pk)
+        for index in create_indexes:
+            DB.execute(index)
+        # Rebuilding the table drops the search index triggers
+        create_unit_index(DB.conn)
+    DB.execute("PRAGMA user_version={}".format(SCHEMA_VERSION))
+    print("Database schema is at version {}".format(SCHEMA_VERSION))
+    return SCHEMA_VERSION
+
+
+def _writer():
+    """Get the batch writer for the current database."""
+    global WRITER
+    if WRITER is None or WRITER.db is not DB:
+        WRITER = BatchWriter(DB, batch_size=WRITE_BATCH_SIZE)
+    return WRITER
+
+
+def _store_image(conn, data):
+    """Add image data to the content addressed image store; return its hash."""
+    imghash = hashlib.sha256(data).hexdigest()
+    conn.execute(
+        "INSERT OR IGNORE INTO imagestore (hash, image, size) VALUES (?, ?, ?)",
+        (imghash, data, len(data)),
+    )
+    return imghash
+
+
+def migrate_imagetest_hashed(DB, batch_size=100):
+    """Move image data in imagetest into the content addressed image store."""
+    conn = DB.conn
+    n = 0
+    while True:
+        rows = conn.execute(
+            """SELECT rowid, image, b64image FROM imagetest
+               WHERE hash IS NULL AND (image IS NOT NULL OR b64image IS NOT NULL)
+               LIMIT ?""",
+            (batch_size,),
+        ).fetchall()
+        if not rows:
+            break
+        with conn:
+            for rowid, image, b64image in rows:
+                data = image if image is not None else base64.decodebytes(bytes(b64image))
+                conn.execute(
+                    "UPDATE imagetest SET hash=?, image=NULL, b64image=NULL WHERE rowid=?",
+                    (_store_image(conn, bytes(data)), rowid),
+                )
+        n = n + len(rows)
+    print("Migrated {} images to the image store".format(n))
+    return n
+
+
+def _known_image_hashes(conn, x_contenthashes, imagetable="imagetest"):
+    """Map OU-XML content hashes onto the hashes of images we already have."""
+    x_contenthashes = [h for h in set(x_contenthashes) if h]
+    known = {}
+    for i in range(0, len(x_contenthashes), 500):
+        batch = x_contenthashes[i : i + 500]
+        known.update(
+            conn.execute(
+                """SELECT x_contenthash, hash FROM {} WHERE hash IS NOT NULL
+                   AND x_contenthash IN ({})""".format(
+                    imagetable, ", ".join("?" * len(batch))
+                ),
+                batch,
+            ).fetchall()
+        )
+    return known
+
+
+def stored_xml_hash(value, column="html_url", table="htmlxml"):
+    """Get the hash of the XML we have stored for a page, looked up by
+       its URL or the link it was scraped from, and when it last changed."""
+    if DB is None or not DB[table].exists():
+        return None, None
+    # Only rows scraped before we kept hashes need their XML reading
+    row = DB.execute(
+        """SELECT xml_hash, changed, CASE WHEN xml_hash IS NULL THEN xml END
+           FROM [{}] WHERE [{}]=? ORDER BY rowid DESC LIMIT 1""".format(table, column),
+        (value,),
+    ).fetchone()
+    if row is None:
+        return None, None
+    xml_hash, changed, xml = row
+    if xml_hash is None and xml is not None:
+        xml_hash = OUXMLDocument(text=xml).hash
+    return xml_hash, changed
+
+
+def _change_tracking(doc, html_url, table="htmlxml"):
+    """Get the change tracking fields for a page's htmlxml row."""
+    now = time.time()
+    xml_hash, changed = stored_xml_hash(html_url, table=table)
+    if changed is None or xml_hash != doc.hash:
+        changed = now
+    return {"xml_hash": doc.hash, "fetched": now, "changed": changed}
+
+
+def _index_sections(typ, html_url, dbrowdict, doc, table="htmlxml"):
+    """Update the section search index for a unit saved to the htmlxml table.
+       Units whose XML hasn't changed since they were indexed are skipped.
+       The rows go through the batch writer, so they are only written if the unit is."""
+    if typ == "XML" and table == "htmlxml":
+        index_unit(DB.conn, html_url, dbrowdict["itemTitle"], doc, writer=_writer())
+
+
 def get_full_html_page_url(html_page_url):
     """The printable page is the full page."""
     if "?" in html_page_url:
@@ -173,7 +451,8 @@ def get_full_html_page_url(html_page_url):
 
 
 def get_sc_page(html_url, s=None):
-    """Try to load a structured content page."""
+    """Try to load a structured content page.
+       The structured content is returned as an OUXMLDocument."""
     # html_page = _get_page('https://learn2.open.ac.uk/mod/repeatactivity/view.php?id=1349903&specialpage=1', s)
     html_page = _get_page(html_url, s)
     if not html_page:
@@ -184,25 +463,23 @@ def get_sc_page(html_url, s=None):
         sc_link = "{}&content=scxml".format(html_page.url)
     else:
         sc_link = "{}?content=scxml".format(html_page.url)
-    sc = _get_page(sc_link, s)
+
+    # The structured content and the full html page can be fetched together
+    full_html_url = get_full_html_page_url(html_page.url)
+    sc, full_html = _get_pages([sc_link, full_html_url], s)
+    if _response_error(sc) or _response_error(full_html):
+        return None, None, None, None
 
     try:
-        raw = sc.content.decode("utf-8")
+        doc = OUXMLDocument(sc.content)
+        doc.text
     except:
         return None, None, None, None
 
     # if it's an XML page we get
-    typ = None
-    if raw.startswith("<?xml"):
-        typ = "XML"
-    elif raw.startswith("<!DOCTYPE html"):
-        typ = "HTML"
-
-    # Get the full html_page
-    full_html_url = get_full_html_page_url(html_page.url)
-    full_html = _get_page(full_html_url, s)
+    typ = doc.doctype
 
-    return typ, html_page.url, raw, full_html.content.decode("utf-8")
+    return typ, html_page.url, doc, full_html.content.decode("utf-8")
 
 
 def html_xml_save(
@@ -222,19 +499,20 @@ def html_xml_save(
         else:
             s = possible_sc_link
 
-    typ, html_page_url, rawxml, html_src = get_sc_page(possible_sc_link, s)
+    typ, html_page_url, doc, html_src = get_sc_page(possible_sc_link, s)
 
     if typ:
         dbrowdict = {
             "possible_sc_link": possible_sc_link,
             "doctype": typ,
             "html_url": html_page_url,
-            "xml": rawxml,
+            "xml": doc.text,
             "html_src": html_src,
             "course_presentation": course_presentation,
             "courseCode": "",
             "courseTitle": "",
             "itemTitle": "",
+            **_change_tracking(doc, html_page_url, table),
         }
     else:
         dbrowdict = {}
@@ -244,16 +522,18 @@ def html_xml_save(
     # Item/CourseTitle
     # Item/ItemTitle
     if typ == "XML":
-        root = etree.fromstring(rawxml.encode("utf-8"))
+        root = doc.root
         # If the course code is contaminated by a presentation suffix, get rid of the presentation code
         dbrowdict["courseCode"] = flatten(root.find("CourseCode")).split("-")[0]
         dbrowdict["courseTitle"] = flatten(root.find("CourseTitle"))
         dbrowdict["itemTitle"] = flatten(root.find("ItemTitle"))
 
     if dbrowdict:
-        DB[table].insert(dbrowdict)
+        with _writer().unit() as writer:
+            writer.add(table, dbrowdict, conflict="OR REPLACE")
+        _index_sections(typ, html_page_url, dbrowdict, doc, table)
 
-    return typ, html_page_url, rawxml, html_src
+    return typ, html_page_url, doc, html_src
 
 
 def _course_code(xml_content):
@@ -262,73 +542,121 @@ def _course_code(xml_content):
     return flatten(root.find(".//CourseCode"))
 
 
-def _xml_figures(xml_content, coursecode="", pageurl=""):
-    """Extract figure elements and paths from XML."""
-    figdicts = []
+# Elements in OU-XML documents that wrap an Image
+FIGURE_TAGS = ["Figure", "InlineFigure", "Equation", "InlineEquation"]
+# The VLE scraper has always stored equations in this order
+VLE_FIGURE_TAGS = ["Figure", "InlineFigure", "InlineEquation", "Equation"]
 
-    try:
-        root = etree.fromstring(xml_content.encode("utf-8"))
-    except:
-        return False
-    figures = (
-        root.findall(".//Figure")
-        + root.findall(".//InlineFigure")
-        + root.findall(".//InlineEquation")
-        + root.findall(".//Equation")
-    )
-    # ??Note that acknowledgements to figures are provided at the end of the XML file with only informal free text/figure number identifers available for associating a particular acknowledgement/copyright assignment with a given image. It would be so much neater if this could be bundled up with the figure itself, or if the figure and the acknowledgement could share the same unique identifier?
-    figdict = {}
 
-    for figure in figures:
-        figdict = {
-            "xpageurl": pageurl,
-            "caption": "",
-            "src": "",
-            "coursecode": coursecode,
-            "desc": "",
-            "owner": "",
-            "item": "",
-            "itemack": "",
-        }
-        img = figure.find("Image")
+def iter_figures(xml_content=None, root=None, tags=FIGURE_TAGS):
+    """Yield figure elements from an OU-XML document in a single pass, in document order.
+       If we don't already have a parsed document, the XML is parsed incrementally
+       and each figure, along with anything before it, is cleared once handled,
+       so we never hold the whole document tree in memory."""
+    if root is not None and len(root):
+        yield from root.iter(*tags)
+        return
 
-        # Is there a way I can actually generate a behind the firewall at least URL for embedding actual images?
-        if img is None:
+    if isinstance(xml_content, str):
+        xml_content = xml_content.encode("utf-8")
+    if isinstance(xml_content, bytes):
+        xml_content = io.BytesIO(xml_content)
+
+    depth = 0
+    for event, el in etree.iterparse(xml_content, events=("start", "end"), tag=tags):
+        if event == "start":
+            depth = depth + 1
             continue
+        depth = depth - 1
+        yield el
+        # Figures nested inside other figures are cleared along with their parent
+        if depth:
+            continue
+        el.clear(keep_tail=True)
+        for node in [el] + list(el.iterancestors()):
+            while node.getprevious() is not None:
+                del node.getparent()[0]
+
+
+def _xml_figure_record(figure, coursecode="", pageurl=""):
+    """Extract figure paths and metadata from a VLE OU-XML figure element."""
+    figdict = {
+        "xpageurl": pageurl,
+        "caption": "",
+        "src": "",
+        "coursecode": coursecode,
+        "desc": "",
+        "owner": "",
+        "item": "",
+        "itemack": "",
+    }
+    img = figure.find("Image")
+
+    # Is there a way I can actually generate a behind the firewall at least URL for embedding actual images?
+    if img is None:
+        return None
 
-        figdict["xurl"] = img.get("src")
+    figdict["xurl"] = img.get("src")
 
-        if figdict["xurl"] is None:
-            continue
+    if figdict["xurl"] is None:
+        return None
 
-        xsrc = img.get("x_imagesrc")
-        figdict["caption"] = flatten(figure.find("Caption")).strip()
-        figdict["alt"] = flatten(figure.find("Alternative")).strip()
-        figdict["alt"] = (
-            figdict["alt"] if figdict["alt"] else "Figure"
-        )  #  should really set this to Figure | InlineEquation etc
-        # in desc, need to find a way of stripping <Number> element from start of description
-        figdict["desc"] = flatten(figure.find("Description"))
-        # <SourceReference><ItemRights><OwnerRef/><ItemRef/><ItemAcknowledgement/></ItemRights></SourceReference>
-        ref = figure.find("SourceReference")
-        if ref is not None:
-            rights = ref.find("ItemRights")
-            if rights is not None:
-                figdict["owner"] = flatten(rights.find("ItemRights"))
-                figdict["item"] = flatten(rights.find("ItemRights"))
-                figdict["itemack"] = flatten(rights.find("ItemAcknowledgement"))
-        # print( 'figures',xsrc,caption,desc,src)
-        # The following tries to hack around things like \t appearing in the path
-        figdict["stub"] = (
-            str(figdict["xurl"].encode("utf-8")).split("\\")[-1].strip("'")
-        )
-        figdict["stub"] = figdict["stub"].split("/")[-1]
-        # print('xmlstub...',figdict['stub'])
-        figdict["minstub"] = figdict["stub"].split(".")[0]
-        figdicts.append(figdict)
+    xsrc = img.get("x_imagesrc")
+    figdict["caption"] = flatten(figure.find("Caption")).strip()
+    figdict["alt"] = flatten(figure.find("Alternative")).strip()
+    figdict["alt"] = (
+        figdict["alt"] if figdict["alt"] else "Figure"
+    )  #  should really set this to Figure | InlineEquation etc
+    # in desc, need to find a way of stripping <Number> element from start of description
+    figdict["desc"] = flatten(figure.find("Description"))
+    # <SourceReference><ItemRights><OwnerRef/><ItemRef/><ItemAcknowledgement/></ItemRights></SourceReference>
+    ref = figure.find("SourceReference")
+    if ref is not None:
+        rights = ref.find("ItemRights")
+        if rights is not None:
+            figdict["owner"] = flatten(rights.find("ItemRights"))
+            figdict["item"] = flatten(rights.find("ItemRights"))
+            figdict["itemack"] = flatten(rights.find("ItemAcknowledgement"))
+    # print( 'figures',xsrc,caption,desc,src)
+    # The following tries to hack around things like \t appearing in the path
+    figdict["stub"] = (
+        str(figdict["xurl"].encode("utf-8")).split("\\")[-1].strip("'")
+    )
+    figdict["stub"] = figdict["stub"].split("/")[-1]
+    # print('xmlstub...',figdict['stub'])
+    figdict["minstub"] = figdict["stub"].split(".")[0]
+    return figdict
+
+
+def _figure_records(figures, record, tags, coursecode="", pageurl=""):
+    """Get the non-empty records for figure elements, grouped by tag in the order
+       of tags and in document order for each tag, the order figures have always
+       been stored in. Records are made as we go, so streamed figures can be cleared."""
+    groups = {tag: [] for tag in tags}
+    for figure in figures:
+        groups[figure.tag].append(record(figure, coursecode, pageurl))
+    return [figdict for tag in tags for figdict in groups[tag] if figdict]
+
+
+def _xml_figures(xml_content, coursecode="", pageurl="", root=None):
+    """Extract figure elements and paths from XML."""
+
+    # ??Note that acknowledgements to figures are provided at the end of the XML file with only informal free text/figure number identifers available for associating a particular acknowledgement/copyright assignment with a given image. It would be so much neater if this could be bundled up with the figure itself, or if the figure and the acknowledgement could share the same unique identifier?
     table = "xmlfigures"
-    if figdicts:
-        DB[table].insert_all(figdicts)
+    try:
+        figdicts = _figure_records(
+            iter_figures(xml_content, root=root, tags=VLE_FIGURE_TAGS),
+            _xml_figure_record,
+            VLE_FIGURE_TAGS,
+            coursecode,
+            pageurl,
+        )
+    except etree.XMLSyntaxError:
+        return False
+    with _writer().unit() as writer:
+        # A page's figures have no key of their own, so replace them all
+        writer.delete(table, "xpageurl", pageurl)
+        writer.add_all(table, figdicts)
     return figdicts
 
 
@@ -337,95 +665,100 @@ def _xml_figures(xml_content, coursecode="", pageurl=""):
 from urllib.parse import urlsplit, urlunsplit
 
 
-def _xml_figures_openlearn(xml_content, coursecode="", pageurl="", root=None):
-    """Identify image elements and paths in OpenLearn XML."""
-    figdicts = []
-    if root is None or not len(root):
-        try:
-            root = etree.fromstring(xml_content)
-        except:
-            return False
-    figures = []
-    for t in ["Figure", "InlineFigure", "Equation", "InlineEquation"]:
-        figures = figures + root.findall(".//{}".format(t))
-    # ??Note that acknowledgements to figures are provided at the end of the XML file with only informal free text/figure number identifers available for associating a particular acknowledgement/copyright assignment with a given image. It would be so much neater if this could be bundled up with the figure itself, or if the figure and the acknowledgement could share the same unique identifier?
-    figdict = {}
-    print("XML figures list len:", len(figures))
-    for figure in figures:
-        figdict = {
-            "xpageurl": pageurl,
-            "caption": "",
-            "src": "",
-            "coursecode": coursecode,
-            "desc": "",
-            "owner": "",
-            "item": "",
-            "itemack": "",
-        }
-        img = figure.find("Image")
-        # The image url as given does not resolve - we need to add in provided hash info
-        
-        if img is None:
-            continue
+def _xml_figure_record_openlearn(figure, coursecode="", pageurl=""):
+    """Extract image paths and metadata from an OpenLearn OU-XML figure element."""
+    figdict = {
+        "xpageurl": pageurl,
+        "caption": "",
+        "src": "",
+        "coursecode": coursecode,
+        "desc": "",
+        "owner": "",
+        "item": "",
+        "itemack": "",
+    }
+    img = figure.find("Image")
+    # The image url as given does not resolve - we need to add in provided hash info
+
+    if img is None:
+        return None
 
-        figdict["srcurl"] = img.get("src")
-        xsrc = img.get("x_imagesrc")
-        if figdict["srcurl"] is None:
-            continue
+    figdict["srcurl"] = img.get("src")
+    xsrc = img.get("x_imagesrc")
+    if figdict["srcurl"] is None:
+        return None
 
-        figdict["x_folderhash"] = img.get("x_folderhash")
-        figdict["x_contenthash"] = img.get("x_contenthash")
-        if (
-            figdict["x_contenthash"] is not None
-            and figdict["x_contenthash"] is not None
-        ):
-            path = urlsplit(figdict["srcurl"])
-            sp = path.path.split("/")
-            path = path._replace(
-                path="/".join(
-                    sp[:-1]
-                    + [figdict["x_folderhash"], figdict["x_contenthash"]]
-                    + [xsrc]  # sp[-1:]
-                )
+    figdict["x_folderhash"] = img.get("x_folderhash")
+    figdict["x_contenthash"] = img.get("x_contenthash")
+    if (
+        figdict["x_contenthash"] is not None
+        and figdict["x_contenthash"] is not None
+    ):
+        path = urlsplit(figdict["srcurl"])
+        sp = path.path.split("/")
+        path = path._replace(
+            path="/".join(
+                sp[:-1]
+                + [figdict["x_folderhash"], figdict["x_contenthash"]]
+                + [xsrc]  # sp[-1:]
             )
-            figdict["imgurl"] = urlunsplit(path)
-            # Want links to images not eg .eps
-            #figdict["srcurl"] = figdict["imgurl"]
-        else:
-            figdict["imgurl"] = ""
-
-        figdict["caption"] = flatten(figure.find("Caption")).strip()
-        figdict["alt"] = flatten(figure.find("Alternative")).strip()
-        figdict["alt"] = (
-            figdict["alt"] if figdict["alt"] else "Figure"
-        )  #  should really set this to Figure | InlineEquation etc
-
-        # in desc, need to find a way of stripping <Number> element from start of description
-        figdict["desc"] = flatten(figure.find("Description"))
-        # <SourceReference><ItemRights><OwnerRef/><ItemRef/><ItemAcknowledgement/></ItemRights></SourceReference>
-        ref = figure.find("SourceReference")
-        if ref is not None:
-            rights = ref.find("ItemRights")
-            if rights is not None:
-                figdict["owner"] = flatten(rights.find("ItemRights"))
-                figdict["item"] = flatten(rights.find("ItemRights"))
-                figdict["itemack"] = flatten(rights.find("ItemAcknowledgement"))
-        # print( 'figures',xsrc,caption,desc,src)
-
-        #figdict["stub"] = figdict["srcurl"].split("/")[-1]
-        #Use full image stub
-        figdict["stub"] = figdict["imgurl"].split("/")[-1]
-        # print('xmlstub...',figdict['stub'])
-        figdict["minstub"] = figdict["stub"].split(".")[0]
+        )
+        figdict["imgurl"] = urlunsplit(path)
+        # Want links to images not eg .eps
+        #figdict["srcurl"] = figdict["imgurl"]
+    else:
+        figdict["imgurl"] = ""
+
+    figdict["caption"] = flatten(figure.find("Caption")).strip()
+    figdict["alt"] = flatten(figure.find("Alternative")).strip()
+    figdict["alt"] = (
+        figdict["alt"] if figdict["alt"] else "Figure"
+    )  #  should really set this to Figure | InlineEquation etc
+
+    # in desc, need to find a way of stripping <Number> element from start of description
+    figdict["desc"] = flatten(figure.find("Description"))
+    # <SourceReference><ItemRights><OwnerRef/><ItemRef/><ItemAcknowledgement/></ItemRights></SourceReference>
+    ref = figure.find("SourceReference")
+    if ref is not None:
+        rights = ref.find("ItemRights")
+        if rights is not None:
+            figdict["owner"] = flatten(rights.find("ItemRights"))
+            figdict["item"] = flatten(rights.find("ItemRights"))
+            figdict["itemack"] = flatten(rights.find("ItemAcknowledgement"))
+    # print( 'figures',xsrc,caption,desc,src)
+
+    #figdict["stub"] = figdict["srcurl"].split("/")[-1]
+    #Use full image stub
+    figdict["stub"] = figdict["imgurl"].split("/")[-1]
+    # print('xmlstub...',figdict['stub'])
+    figdict["minstub"] = figdict["stub"].split(".")[0]
+    return figdict
 
-        figdicts.append(figdict)
 
+def _xml_figures_openlearn(xml_content, coursecode="", pageurl="", root=None):
+    """Identify image elements and paths in OpenLearn XML."""
+    # ??Note that acknowledgements to figures are provided at the end of the XML file with only informal free text/figure number identifers available for associating a particular acknowledgement/copyright assignment with a given image. It would be so much neater if this could be bundled up with the figure itself, or if the figure and the acknowledgement could share the same unique identifier?
     table = "xmlfigures"
-    if figdicts:
-        DB[table].insert_all(figdicts)
+    try:
+        figdicts = _figure_records(
+            iter_figures(xml_content, root=root),
+            _xml_figure_record_openlearn,
+            FIGURE_TAGS,
+            coursecode,
+            pageurl,
+        )
+    except etree.XMLSyntaxError:
+        return False
+    with _writer().unit() as writer:
+        # A page's figures have no key of their own, so replace them all
+        writer.delete(table, "xpageurl", pageurl)
+        writer.add_all(table, figdicts)
+    print("XML figures list len:", len(figdicts))
 
+    if figdicts:
         # We can also get the actual images from the imgurl location
-        saveImages(figdicts, imgurlkey="imgurl")
+        with _writer().unit():
+            saveImages(figdicts, imgurlkey="imgurl")
 
     return figdicts
 
@@ -443,7 +776,8 @@ def _xml_glossary(xml_content, coursecode="", pageurl=""):
     gloss = root.findall(".//{}".format("??? TO DO "))
     table = "xmlglossary"
     if glossdicts:
-        DB[table].insert_all(glossdicts)
+        with _writer().unit() as writer:
+            writer.add_all(table, glossdicts)
 
 
 # -
@@ -451,37 +785,84 @@ def _xml_glossary(xml_content, coursecode="", pageurl=""):
 # requires the session
 def get_as_base64(url, s=None):
     """Get data as base64 encoded data."""
-    data = _get_page(url, s).content
+    r = _get_page(url, s)
+    error = _response_error(r)
+    if error:
+        raise OSError("Couldn't get {}: {}".format(url, error))
+    data = r.content
 
     return base64.b64encode(data), data
 
 
-def saveImages(_figures_list, s=None, imagetable="imagetest", imgurlkey="hurl"):
+def saveImages(
+    _figures_list, s=None, imagetable="imagetest", imgurlkey="hurl", storage=None
+):
     """Save images into database."""
 
+    storage = storage or IMAGE_STORAGE
+
     if not imagetable:
         imagetable = "imagetest"
 
     # print("Saving images into database...")
-    imagedicts = []
-    imgkeys = []
-    # print('figures list',_figures_list)
+    # Only fetch each image once
+    _figures = {}
     for _figure in _figures_list:
-        b64image, d = get_as_base64(_figure[imgurlkey], s)
-        # with open(t['stub'], 'wb') as f:
-        #    f.write(d)
-
-        imagedict = {
-            "b64image": b64image,
-            "stub": _figure["stub"],
-            "minstub": _figure["minstub"],
-        }
-        if imagedict["stub"] not in imgkeys:
-            imgkeys.append(imagedict["stub"])
+        _figures.setdefault(_figure["stub"], _figure)
+    _figures = list(_figures.values())
+
+    # If the OU-XML content hash identifies an image we already have,
+    # we don't need to fetch it again
+    known = {}
+    if storage == "hashed" and "x_contenthash" in DB[imagetable].columns_dict:
+        known = _known_image_hashes(
+            DB.conn, [f.get("x_contenthash") for f in _figures], imagetable
+        )
+    # Images with the same content hash only need fetching once
+    _fetch = {}
+    for _figure in _figures:
+        if _figure.get("x_contenthash") not in known:
+            key = _figure.get("x_contenthash") or _figure[imgurlkey]
+            _fetch.setdefault(key, _figure[imgurlkey])
+
+    # print('figures list',_figures_list)
+    responses = dict(zip(_fetch, _get_pages(_fetch.values(), s)))
+    imagedicts = []
+    with _writer().unit() as writer:
+        for _figure in _figures:
+            imagedict = {
+                "stub": _figure["stub"],
+                "minstub": _figure["minstub"],
+                "pageurl": _figure.get("xpageurl") or _figure.get("hpageurl"),
+            }
+            if _figure.get("x_contenthash") in known:
+                imagedict["hash"] = known[_figure["x_contenthash"]]
+                imagedict["x_contenthash"] = _figure["x_contenthash"]
+                imagedicts.append(imagedict)
+                continue
+            r = responses[_figure.get("x_contenthash") or _figure[imgurlkey]]
+            error = _response_error(r)
+            if error:
+                print("Failed to get image: {} ({})".format(_figure[imgurlkey], error))
+                continue
+            # with open(t['stub'], 'wb') as f:
+            #    f.write(d)
+
+            if storage == "base64":
+                imagedict["b64image"] = base64.b64encode(r.content)
+            elif storage == "blob":
+                imagedict["image"] = r.content
+            else:
+                imagedict["hash"] = hashlib.sha256(r.content).hexdigest()
+                imagedict["x_contenthash"] = _figure.get("x_contenthash")
+                writer.add(
+                    "imagestore",
+                    {"hash": imagedict["hash"], "image": r.content, "size": len(r.content)},
+                    conflict="OR IGNORE",
+                )
             imagedicts.append(imagedict)
 
-    if imagedicts:
-        DB[imagetable].insert_all(imagedicts)
+        writer.add_all(imagetable, imagedicts, conflict="OR REPLACE")
 
 
 # The HTML figures should be pulled from the full HTML page
@@ -489,6 +870,8 @@ def _html_figures(
     html_content, s=None, coursecode="", pageurl="", imagetable="imagetest"
 ):
     """Extract images from HTML page."""
+    from bs4 import BeautifulSoup
+
     # display('make html soup')
     soup = BeautifulSoup(html_content, "lxml")
     # result = etree.tostring(html, pretty_print=True, method="html")
@@ -525,12 +908,12 @@ def _html_figures(
         # scraperwiki.sqlite.save(unique_keys=[],table_name='figures',data={'ccu':courseCode,'src':src,'xsrc':xsrc,'caption':caption,'desc':desc,'ccid':courseID,'xid':xID,'slug':slug})
     table = "htmlfigures"
     # print('figdicts',figdicts)
-    if figdicts:
-        DB[table].insert_all(figdicts)
+    with _writer().unit() as writer:
+        writer.add_all(table, figdicts, conflict="OR REPLACE")
 
-    # print(', '.join([f['minstub'] for f in figdicts]))
+        # print(', '.join([f['minstub'] for f in figdicts]))
 
-    saveImages(figdicts, s, imagetable=imagetable)
+        saveImages(figdicts, s, imagetable=imagetable)
 
     return figdicts
 
@@ -547,81 +930,96 @@ def get_openlearn_html_zip(html_url, s=None):
 
         
 # Page grabbers for OpenLearn content
-def get_openlearn_sc_page(html_url, s=None, xml_url=None, get_html=True):
-    """Try to load a structured content page."""
+def get_openlearn_sc_page(html_url, s=None, xml_url=None, get_html=True, raise_errors=False):
+    """Try to load a structured content page.
+       The structured content is returned as an OUXMLDocument.
+       If a page can't be fetched, or the server returns an error for it,
+       we return Nones, or with raise_errors raise an OSError saying why."""
     # html_page = _get_page('https://learn2.open.ac.uk/mod/repeatactivity/view.php?id=1349903&specialpage=1', s)
 
     if "content-section" not in html_url:
         print("I don't think I can work with that HTML URL...")
         return None, None, None, None
 
-    html_page = _get_page(html_url, s)
-    if not html_page:
-        return None, None, None, None
-
     # print(html_page.url)
     html_page_url_stub = html_url.split("/content-section")[0]
     if xml_url is None:
         sc_link = "{}/altformat-ouxml".format(html_page_url_stub)
     else:
         sc_link = xml_url
-
-    sc = _get_page(sc_link, s)
+    full_html_url = "{}/altformat-html".format(html_page_url_stub)
+
+    # None of these depend on each other, so fetch them all at once
+    urls = [html_url, sc_link] + ([full_html_url] if get_html else [])
+    responses = _get_pages(urls, s)
+    # Error pages mustn't be mistaken for content
+    for url, r in zip(urls, responses):
+        error = _response_error(r)
+        if error:
+            print("Couldn't get {}: {}".format(url, error))
+            if raise_errors:
+                raise OSError("{}: {}".format(error, url))
+            return None, None, None, None
+    html_page, sc, *full_html = responses
 
     try:
         print("Decoding utf-8...")
-        raw = sc.content.decode("utf-8")
+        doc = OUXMLDocument(sc.content)
+        doc.text
         print("...done decoding utf-8")
     except:
         return None, None, None, None
 
     # if it's an XML page we get
-    typ = None
-    if raw.startswith("<?xml"):
-        typ = "XML"
-    elif raw.startswith("<!DOCTYPE html"):
-        typ = "HTML"
+    typ = doc.doctype
 
     # Get the full html_page
     # For OpenLearn, do we really need to do this?
     # We can get the html by just downloading the zip package
     # The HTML zip package also has all the media assets in it?
     if get_html:
-        print("Getting full html...")
-        full_html_url = "{}/altformat-html".format(html_page_url_stub)
-        full_html = _get_page(full_html_url, s)
-        _html = full_html.content 
-        print("...done getting full html")
+        _html = full_html[0].content
     else:
         _html = ''
-    return typ, html_page_url_stub, raw, _html # .decode("utf-8")
+    return typ, html_page_url_stub, doc, _html # .decode("utf-8")
 
 
 def html_xml_save_openlearn(
-    s=None, possible_sc_link=None, table="htmlxml", course_presentation=None, get_html=True
+    s=None,
+    possible_sc_link=None,
+    table="htmlxml",
+    course_presentation=None,
+    get_html=True,
+    page=None,
 ):
-    """Save HTML and XML from an OpenLearn OU-XML document URL."""
+    """Save HTML and XML from an OpenLearn OU-XML document URL.
+       If the page has already been fetched with get_openlearn_sc_page(),
+       it can be passed in as `page`."""
 
     if not possible_sc_link:
         # should really raise error here
         print("need a link")
 
-    if not s:
-        s = getSession()
+    if page is None:
+        # There's no point opening a session if we can't go online
+        if not s and not get_fetcher().offline:
+            s = getSession()
 
-    print("getting ou-xml")
-    typ, html_page_url, rawxml, html_src = get_openlearn_sc_page(possible_sc_link, s, get_html=get_html)
+        print("getting ou-xml")
+        page = get_openlearn_sc_page(possible_sc_link, s, get_html=get_html)
+    typ, html_page_url, doc, html_src = page
 
     if typ:
         dbrowdict = {
             "possible_sc_link": possible_sc_link,
             "doctype": typ,
             "html_url": html_page_url,
-            "xml": rawxml,  #'html_src': html_src,
+            "xml": doc.text,  #'html_src': html_src,
             "course_presentation": course_presentation,
             "courseCode": "",
             "courseTitle": "",
             "itemTitle": "",
+            **_change_tracking(doc, html_page_url, table),
         }
     else:
         dbrowdict = {}
@@ -632,7 +1030,7 @@ def html_xml_save_openlearn(
     # Item/ItemTitle
     if typ == "XML":
         print("parsing XML...")
-        root = etree.fromstring(rawxml.encode("utf-8"))
+        root = doc.root
         # If the course code is contaminated by a presentation suffix, get rid of the presentation code
         dbrowdict["courseCode"] = flatten(root.find("CourseCode")).split("-")[0]
         dbrowdict["courseTitle"] = flatten(root.find("CourseTitle"))
@@ -643,10 +1041,12 @@ def html_xml_save_openlearn(
 
     if dbrowdict:
         print("saving xml into db...")
-        DB[table].insert(dbrowdict)
+        with _writer().unit() as writer:
+            writer.add(table, dbrowdict, conflict="OR REPLACE")
+        _index_sections(typ, html_page_url, dbrowdict, doc, table)
         print("...done saving xml into db")
 
-    return typ, html_page_url, rawxml, html_src, root
+    return typ, html_page_url, doc, html_src, root
 
 
 def scrape_unit_openlearn_base(
@@ -657,8 +1057,11 @@ def scrape_unit_openlearn_base(
     course_presentation="unknown",
     dbname=None,
     newdb=False,
+    incremental=False,
 ):
-    """Scrape an OpenLearn unit homepage for OU-XML link."""
+    """Scrape an OpenLearn unit homepage for OU-XML link.
+       With incremental, the figures and images for a unit whose OU-XML
+       hasn't changed since it was last scraped aren't extracted again."""
     # OpenLearn is easier because we can derive the image URL from the XML
     # OpenLearn has different pattern on creating the XML URL but html_xml_save should work - scxml is good?
     # Test that we can get a content0 page
@@ -674,38 +1077,71 @@ def scrape_unit_openlearn_base(
         setup_DB("dummydb.db")
 
     for possible_sc_link in possible_sc_links:
-        typ, html_page_url, rawxml, html_src, root = html_xml_save_openlearn(
-            s, possible_sc_link, course_presentation=course_presentation, get_html=False
+        _scrape_openlearn_unit(
+            s,
+            possible_sc_link,
+            coursecode=coursecode,
+            course_presentation=course_presentation,
+            incremental=incremental,
+        )
+
+
+def _scrape_openlearn_unit(
+    s=None,
+    possible_sc_link=None,
+    coursecode="",
+    course_presentation="unknown",
+    incremental=False,
+    page=None,
+):
+    """Scrape a single OpenLearn unit, optionally from an already fetched page.
+       Returns the document type, or None if we couldn't get the OU-XML, and
+       whether the OU-XML was unchanged."""
+    previous_hash, _ = (
+        stored_xml_hash(possible_sc_link, "possible_sc_link") if incremental else (None, None)
+    )
+    # Everything we save for a unit is written together, or not at all
+    with _writer().unit():
+        typ, html_page_url, doc, html_src, root = html_xml_save_openlearn(
+            s,
+            possible_sc_link,
+            course_presentation=course_presentation,
+            get_html=False,
+            page=page,
         )
         print(typ)
+        if typ and previous_hash == doc.hash:
+            print("OU-XML unchanged: {}".format(possible_sc_link))
+            return typ, True
         if typ == "XML":
             print("trying images")
             print("going into _xml_figures_openlearn")
             _xml_figures_openlearn(
-                rawxml.encode("utf-8"),
+                doc.raw,
                 coursecode=coursecode,
                 pageurl=html_page_url,
                 root=root,
             )
-            # Sometimes we can get a path to the image from the XML? Always for OpenLearn in Image[@src]?
-            # Instead will have to fill the gaps in from the HTML.
-            # So maybe we should just get the images from the html anyway?
-            # saveImages(figdicts, s, imagetable=imagetable, imgurlkey='imgurl')
+        # Sometimes we can get a path to the image from the XML? Always for OpenLearn in Image[@src]?
+        # Instead will have to fill the gaps in from the HTML.
+        # So maybe we should just get the images from the html anyway?
+        # saveImages(figdicts, s, imagetable=imagetable, imgurlkey='imgurl')
 
-            # TO DO - not convinced about the HTML..
-            # Can we get by with just the xml?
+        # TO DO - not convinced about the HTML..
+        # Can we get by with just the xml?
 
-            # print('going into _html_figures_openlearn')
-            # _html_figures( html_src, s, coursecode=coursecode,
-            #              pageurl=html_page_url, imagetable=imagetable)
+        # print('going into _html_figures_openlearn')
+        # _html_figures( html_src, s, coursecode=coursecode,
+        #              pageurl=html_page_url, imagetable=imagetable)
 
-            # Get glossary items
-            # _xml_glossary(rawxml.encode("utf-8"),
-            #                       coursecode=coursecode, pageurl=html_page_url)
+        # Get glossary items
+        # _xml_glossary(rawxml.encode("utf-8"),
+        #                       coursecode=coursecode, pageurl=html_page_url)
 
-            # Get Learning Objectives
-            # _xml_lo(rawxml.encode("utf-8"),
-            #                       coursecode=coursecode, pageurl=html_page_url)
+        # Get Learning Objectives
+        # _xml_lo(rawxml.encode("utf-8"),
+        #                       coursecode=coursecode, pageurl=html_page_url)
+    return typ, False
 
 
 # -
@@ -737,8 +1173,11 @@ def scrape_course_base(
     course_presentation="unknown",
     dbname=None,
     newdb=False,
+    incremental=False,
 ):
-    """ Scrape a course... Or try to..."""
+    """ Scrape a course... Or try to...
+        With incremental, the figures and images for a page whose structured
+        content hasn't changed since it was last scraped aren't extracted again."""
 
     if dbname:
         setup_DB(dbname, newdb=newdb)
@@ -747,27 +1186,39 @@ def scrape_course_base(
         setup_DB("dummydb.db")
 
     for possible_sc_link in possible_sc_links:
-
-        typ, html_page_url, rawxml, html_src = html_xml_save(
-            s, possible_sc_link, course_presentation=course_presentation
+        previous_hash, _ = (
+            stored_xml_hash(possible_sc_link, "possible_sc_link") if incremental else (None, None)
         )
+        # Everything we save for a page is written together, or not at all
+        with _writer().unit():
+            typ, html_page_url, doc, html_src = html_xml_save(
+                s, possible_sc_link, course_presentation=course_presentation
+            )
 
-        if not typ:
-            continue
-        # print('Trying to save images...')
-        # The images should also be saved with module presentation info?
-        _xml_figures(rawxml, coursecode=coursecode, pageurl=html_page_url)
-        _html_figures(
-            html_src,
-            s,
-            coursecode=coursecode,
-            pageurl=html_page_url,
-            imagetable=imagetable,
-        )
+            if not typ:
+                continue
+            if previous_hash == doc.hash:
+                print("Structured content unchanged: {}".format(possible_sc_link))
+                continue
+            # print('Trying to save images...')
+            # The images should also be saved with module presentation info?
+            _xml_figures(
+                doc.raw,
+                coursecode=coursecode,
+                pageurl=html_page_url,
+                root=doc.root if typ == "XML" else None,
+            )
+            _html_figures(
+                html_src,
+                s,
+                coursecode=coursecode,
+                pageurl=html_page_url,
+                imagetable=imagetable,
+            )
 
 
 def scrape_provided_links(
-    s=None, provided_links=None, course_presentation=None, dbname=None
+    s=None, provided_links=None, course_presentation=None, dbname=None, incremental=False
 ):
     """Scrape provided possible structured content links."""
 
@@ -786,11 +1237,12 @@ def scrape_provided_links(
         possible_sc_links=provided_links,
         coursecode=COURSE_CODE,
         course_presentation=course_presentation,
+        incremental=incremental,
     )
 
 
 def scrape_course_presentation(
-    s=None, course_presentation=None, dbname=None, view_pages_only=False
+    s=None, course_presentation=None, dbname=None, view_pages_only=False, incremental=False
 ):
     """Scrape the VLE for a particular presentation of a particular module."""
 
@@ -815,15 +1267,23 @@ def scrape_course_presentation(
         possible_sc_links=possible_sc_links,
         coursecode=COURSE_CODE,
         course_presentation=course_presentation,
+        incremental=incremental,
     )
 
 
 # OpenLearn tools
+# The OPML file lists all OpenLearn units by topic area
+OPENLEARN_OPML_URL = "http://openlearn.open.ac.uk/rss/file.php/stdfeed/1/full_opml.xml"
+
+
 def getUnitLocations(q="", goforit=False):
-    """Get URLs and unit names for OpenLearn units."""
-    # The OPML file lists all OpenLearn units by topic area
-    srcUrl = "http://openlearn.open.ac.uk/rss/file.php/stdfeed/1/full_opml.xml"
-    r = requests.get("http://openlearn.open.ac.uk/rss/file.php/stdfeed/1/full_opml.xml")
+    """Get URLs and unit names for OpenLearn units.
+       With goforit, the units are also harvested into the current database."""
+    srcUrl = OPENLEARN_OPML_URL
+    r = _get_page(srcUrl)
+    error = _response_error(r)
+    if error:
+        raise OSError("Couldn't get the OpenLearn unit list from {}: {}".format(srcUrl, error))
     rawxml = r.content
     root = etree.fromstring(rawxml)
     # tree = etree.parse(srcUrl)
@@ -848,12 +1308,6 @@ def getUnitLocations(q="", goforit=False):
             unit["url"] = url
             unit["srcurl"] = rssurl
             unit["name"] = it
-            # print(url)
-            xmlurl = url.replace("content-section-0", "altformat-ouxml")
-            # print(xmlurl)
-            if goforit:
-                c = requests.get(xmlurl)
-                _xml_figures(c.content)
             units.append(unit)
 
     if q:
@@ -863,17 +1317,123 @@ def getUnitLocations(q="", goforit=False):
             if "name" in unit
             and all(word in unit["name"].lower() for word in q.lower().split())
         ]
+    if goforit:
+        harvest_units(units)
     return units
 
 
-# ## Generate HTML Tables of Unit Listings
+# Harvest progress, so that an interrupted harvest can pick up where it left off
+create_harvest = '''
+CREATE TABLE IF NOT EXISTS harvest (
+    url TEXT PRIMARY KEY,
+    name TEXT,
+    status TEXT,
+    attempts INTEGER DEFAULT 0,
+    error TEXT,
+    updated REAL
+);'''
 
-# +
-import pandas as pd
 
+def _harvest_status(url, status, error=None):
+    """Record the harvest status of a unit."""
+    with DB.conn:
+        DB.execute(
+            """UPDATE harvest SET status=?, error=?, updated=?,
+               attempts=attempts + (CASE WHEN ? IN ('done', 'failed') THEN 1 ELSE 0 END)
+               WHERE url=?""",
+            (status, error, time.time(), status, url),
+        )
 
+
+def harvest_units(units, dbname=None, s=None, refresh=False, max_attempts=3):
+    """Scrape OpenLearn units, as listed by getUnitLocations(), into one database.
+       Progress is tracked in the harvest table: units that are already done,
+       or have failed max_attempts times, are skipped, so an interrupted harvest
+       can just be run again. With refresh, every unit is harvested again,
+       although figures and images are only extracted for changed OU-XML.
+       The OU-XML for several units is fetched at once, as the fetcher's
+       concurrency allows, while the units are saved one at a time.
+       Returns the number of units in each state."""
+    if dbname:
+        setup_DB(dbname)
+    elif not DB:
+        setup_DB("dummydb.db")
+    DB.execute(create_harvest)
+
+    with DB.conn:
+        DB.conn.executemany(
+            "INSERT OR IGNORE INTO harvest (url, name, status) VALUES (?, ?, 'pending')",
+            [(unit["url"], unit.get("name")) for unit in units],
+        )
+        if refresh:
+            DB.conn.executemany(
+                "UPDATE harvest SET status='pending', attempts=0, error=NULL WHERE url=?",
+                [(unit["url"],) for unit in units],
+            )
+    todo = set(
+        url
+        for (url,) in DB.execute(
+            "SELECT url FROM harvest WHERE status!='done' AND attempts<?", (max_attempts,)
+        )
+    )
+    urls = [unit["url"] for unit in units if unit["url"] in todo]
+    print("Harvesting {} of {} units".format(len(urls), len(units)))
+
+    # There's no point opening a session if we can't go online
+    if not s and urls and not get_fetcher().offline:
+        s = getSession()
+
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Each page is two requests, fetched together, so this keeps
+    # the fetcher's connections busy without overflowing its pool
+    workers = max(1, get_fetcher().concurrency // 2)
+    # Keep a few pages in hand, but don't hold the whole catalogue in memory
+    window = 2 * workers
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        urls = iter(urls)
+        while True:
+            while len(pending) < window:
+                url = next(urls, None)
+                if url is None:
+                    break
+                pending.append(
+                    (url, pool.submit(get_openlearn_sc_page, url, s, None, False, True))
+                )
+            if not pending:
+                break
+            url, future = pending.popleft()
+            try:
+                typ, unchanged = _scrape_openlearn_unit(
+                    s, url, incremental=True, page=future.result()
+                )
+            except Exception as e:
+                _harvest_status(url, "failed", repr(e))
+                continue
+            # Anything but OU-XML, such as an HTML error page, is tried again
+            if typ == "XML":
+                _harvest_status(url, "done")
+            else:
+                _harvest_status(url, "failed", "Got {} rather than OU-XML".format(typ or "nothing"))
+
+    listed = set(unit["url"] for unit in units)
+    counts = {}
+    for url, status in DB.execute("SELECT url, status FROM harvest"):
+        if url in listed:
+            counts[status] = counts.get(status, 0) + 1
+    print("Harvest status: {}".format(counts))
+    return counts
+
+
+# ## Generate HTML Tables of Unit Listings
+
+# +
 def rowparse(row):
     """Parse each row for creating HTML table."""
+    import pandas as pd
+
     url = row['url']
     path = url.replace('https://www.open.edu/openlearn/', '').split('/')[:-1]
     stub = path[-1]
@@ -889,6 +1449,8 @@ def rowparse(row):
 
 def get_units_df(q=''):
     """Get OpenLearn unit listing as a dataframe."""
+    import pandas as pd
+
     units = getUnitLocations(q=q)
     df = pd.DataFrame(units)
     df[['path', 'stub', 'section', 'subsection']] = df.apply(rowparse, axis=1)
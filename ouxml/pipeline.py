@@ -0,0 +1,59 @@
+# pipeline.py
+
+# A pipeline of text transforms for generated files.
+# Each stage is a function that takes a file path and its text and returns
+# a (possibly new) path and text. All the stages are run on each file in
+# memory, one file at a time, so a file only needs to be written once
+# however many stages rewrite it.
+
+import time
+
+
+class TextPipeline:
+    """Run named text transform stages over a dict of path -> text, keeping
+       per-stage timing counters."""
+
+    def __init__(self, stages=None):
+        # name -> function(path, txt) -> (path, txt), in the order they run
+        self.stages = {}
+        # name -> {"files": files processed, "changed": files changed, "time": seconds}
+        self.counters = {}
+        for name, fn in (stages or []):
+            self.add(name, fn)
+
+    def add(self, name, fn):
+        """Add a stage to the end of the pipeline."""
+        self.stages[name] = fn
+        self.counters[name] = {"files": 0, "changed": 0, "time": 0.0}
+        return self
+
+    def process(self, path, txt):
+        """Run a single file through every stage."""
+        for name, fn in self.stages.items():
+            counter = self.counters[name]
+            start = time.perf_counter()
+            _path, _txt = fn(path, txt)
+            counter["time"] = counter["time"] + time.perf_counter() - start
+            counter["files"] = counter["files"] + 1
+            if _path != path or _txt != txt:
+                counter["changed"] = counter["changed"] + 1
+            path, txt = _path, _txt
+        return path, txt
+
+    def run(self, files):
+        """Run each file in a dict of path -> text through the pipeline
+           and return the processed files as a new dict."""
+        processed = {}
+        for path, txt in files.items():
+            path, txt = self.process(path, txt)
+            processed[path] = txt
+        return processed
+
+    def report(self):
+        """Print the timing counters for each stage."""
+        for name, counter in self.counters.items():
+            print(
+                "{}: {} files, {} changed, {:.1f}ms".format(
+                    name, counter["files"], counter["changed"], counter["time"] * 1000
+                )
+            )
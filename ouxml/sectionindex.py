@@ -0,0 +1,199 @@
+# sectionindex.py
+
+# A full text index over the sessions and sections of the OU-XML stored in
+# the htmlxml table, so content can be found across many units without
+# parsing their XML again.
+# The text of each session and section is kept in the sections table, with an
+# FTS5 index (sections_fts) over it that triggers keep in step with the table.
+# The section_units table records the hash of the XML each unit was indexed
+# from, so only units whose XML changed need indexing again.
+
+from ouxml.dbquery import connection, query_rows, query_value
+from ouxml.document import OUXMLDocument
+from ouxml.units import fts_query
+
+create_sections = """
+CREATE TABLE IF NOT EXISTS sections (
+    id INTEGER PRIMARY KEY,
+    html_url TEXT,
+    unit TEXT,
+    path TEXT,
+    title TEXT,
+    text TEXT
+);
+"""
+
+create_sections_fts = """
+CREATE VIRTUAL TABLE IF NOT EXISTS sections_fts USING fts5(
+    title, text, unit, path, content='sections', content_rowid='id'
+);
+"""
+
+create_section_units = """
+CREATE TABLE IF NOT EXISTS section_units (
+    html_url TEXT PRIMARY KEY,
+    xml_hash TEXT
+);
+"""
+
+create_sections_triggers = [
+    """
+CREATE TRIGGER IF NOT EXISTS sections_fts_ai AFTER INSERT ON sections BEGIN
+  INSERT INTO sections_fts(rowid, title, text, unit, path)
+  VALUES (new.id, new.title, new.text, new.unit, new.path);
+END;
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS sections_fts_ad AFTER DELETE ON sections BEGIN
+  INSERT INTO sections_fts(sections_fts, rowid, title, text, unit, path)
+  VALUES ('delete', old.id, old.title, old.text, old.unit, old.path);
+END;
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS sections_fts_au AFTER UPDATE ON sections BEGIN
+  INSERT INTO sections_fts(sections_fts, rowid, title, text, unit, path)
+  VALUES ('delete', old.id, old.title, old.text, old.unit, old.path);
+  INSERT INTO sections_fts(rowid, title, text, unit, path)
+  VALUES (new.id, new.title, new.text, new.unit, new.path);
+END;
+""",
+]
+
+# The separator between session and section titles in a section path
+PATH_SEP = " > "
+
+
+def create_section_index(conn):
+    """Create the section index tables if they don't exist."""
+    conn = connection(conn)
+    with conn:
+        conn.execute(create_sections)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sections_html_url ON sections (html_url)")
+        conn.execute(create_sections_fts)
+        conn.execute(create_section_units)
+        for trigger in create_sections_triggers:
+            conn.execute(trigger)
+
+
+def _flatten_all(els):
+    from ouxml.moodlescraper import flatten
+
+    # Skip comments and processing instructions
+    return " ".join(" ".join(flatten(el) for el in els if isinstance(el.tag, str)).split())
+
+
+def unit_sections(root):
+    """Yield (path, title, text) for each session of an OU-XML document,
+       and each section in it. A session's text is whatever isn't in its sections."""
+    from ouxml.moodlescraper import flatten
+
+    for session in root.iter("Session"):
+        session_title = " ".join(flatten(session.find("Title")).split())
+        yield session_title, session_title, _flatten_all(
+            el for el in session if el.tag not in ("Title", "Section")
+        )
+        for section in session.findall("Section"):
+            title = " ".join(flatten(section.find("Title")).split())
+            yield session_title + PATH_SEP + title, title, _flatten_all(
+                el for el in section if el.tag != "Title"
+            )
+
+
+def _remove_unit(conn, html_url):
+    conn.execute("DELETE FROM sections WHERE html_url=?", (html_url,))
+    conn.execute("DELETE FROM section_units WHERE html_url=?", (html_url,))
+
+
+def index_unit(conn, html_url, unit, doc, force=False, writer=None):
+    """Index the sessions and sections of a unit's OU-XML, an OUXMLDocument,
+       unless it has already been indexed from the same XML.
+       With a BatchWriter, the rows are queued on it rather than written, so
+       they land along with the rest of the unit's rows, or not at all.
+       Returns whether the unit was indexed."""
+    conn = connection(conn)
+    xml_hash = doc.hash
+    if not force and query_value(
+        conn, "SELECT xml_hash FROM section_units WHERE html_url=?", (html_url,)
+    ) == xml_hash:
+        return False
+    rows = [
+        (html_url, unit, path, title, text) for path, title, text in unit_sections(doc.root)
+    ]
+    if writer is not None:
+        writer.delete("sections", "html_url", html_url)
+        writer.delete("section_units", "html_url", html_url)
+        names = ["html_url", "unit", "path", "title", "text"]
+        writer.add_all("sections", (dict(zip(names, row)) for row in rows))
+        writer.add("section_units", {"html_url": html_url, "xml_hash": xml_hash})
+        return True
+    with conn:
+        _remove_unit(conn, html_url)
+        conn.executemany(
+            "INSERT INTO sections (html_url, unit, path, title, text) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        conn.execute("INSERT INTO section_units VALUES (?, ?)", (html_url, xml_hash))
+    return True
+
+
+def update_section_index(conn, rebuild=False):
+    """Bring the section index up to date with the OU-XML in the htmlxml table.
+       Only units whose XML changed since they were indexed are parsed again,
+       unless rebuild is set. Returns counts of units indexed, unchanged and removed."""
+    conn = connection(conn)
+    create_section_index(conn)
+    if rebuild:
+        with conn:
+            conn.execute("DELETE FROM sections")
+            conn.execute("DELETE FROM section_units")
+    indexed = {
+        row["html_url"]: row["xml_hash"]
+        for row in query_rows(conn, "SELECT html_url, xml_hash FROM section_units")
+    }
+    counts = {"indexed": 0, "unchanged": 0, "removed": 0}
+    # Databases created before incremental scrapes don't have hashes
+    columns = {row["name"] for row in query_rows(conn, "PRAGMA table_info(htmlxml)")}
+    units = list(
+        query_rows(
+            conn,
+            "SELECT html_url, itemTitle, {} AS xml_hash FROM htmlxml WHERE doctype='XML'".format(
+                "xml_hash" if "xml_hash" in columns else "NULL"
+            ),
+        )
+    )
+    for unit in units:
+        # Rows without hashes have to be hashed from the XML
+        if unit["xml_hash"] is not None and indexed.get(unit["html_url"]) == unit["xml_hash"]:
+            counts["unchanged"] += 1
+            continue
+        xml = query_value(conn, "SELECT xml FROM htmlxml WHERE html_url=?", (unit["html_url"],))
+        doc = OUXMLDocument(text=xml)
+        if index_unit(conn, unit["html_url"], unit["itemTitle"], doc):
+            counts["indexed"] += 1
+        else:
+            counts["unchanged"] += 1
+    # Forget units that have gone from the database
+    current = {unit["html_url"] for unit in units}
+    with conn:
+        for html_url in set(indexed) - current:
+            _remove_unit(conn, html_url)
+            counts["removed"] += 1
+    return counts
+
+
+def search_sections(conn, term, limit=20):
+    """Find the sessions and sections whose text or titles contain words starting
+       with each of the words in term, best matches first, with a snippet of the
+       matching text."""
+    query = fts_query(term)
+    if not query:
+        return []
+    return list(
+        query_rows(
+            conn,
+            """SELECT s.html_url, s.unit, s.path, s.title,
+                      snippet(sections_fts, 1, '[', ']', '...', 16) AS snippet
+               FROM sections_fts JOIN sections s ON s.id=sections_fts.rowid
+               WHERE sections_fts MATCH ? ORDER BY sections_fts.rank LIMIT ?""",
+            (query, limit),
+        )
+    )
@@ -0,0 +1,159 @@
+# units.py
+
+# Looking up units in the htmlxml table.
+# Exact lookups go by row id or an indexed column (html_url is the primary
+# key, and courseCode and itemTitle are indexed), and titles can be searched
+# through an FTS5 index over itemTitle and courseTitle that triggers keep in
+# step with the table.
+
+import re
+import sqlite3
+
+from ouxml.dbquery import connection, query_row, query_rows
+
+# The columns returned for a unit by default; the xml can be asked for separately
+UNIT_COLUMNS = ["rowid", "html_url", "courseCode", "courseTitle", "itemTitle"]
+
+# Columns a unit can be looked up by exactly
+LOOKUP_KEYS = ["rowid", "html_url", "courseCode", "itemTitle", "possible_sc_link"]
+
+UNIT_FTS = "htmlxml_fts"
+
+create_unit_fts = """
+CREATE VIRTUAL TABLE IF NOT EXISTS htmlxml_fts USING fts5(itemTitle, courseTitle);
+"""
+
+# Rows are upserted with INSERT OR REPLACE, which doesn't fire delete triggers,
+# so the entry for a row that is about to be replaced is removed before the insert.
+create_unit_fts_triggers = {
+    "htmlxml_fts_bi": """
+CREATE TRIGGER IF NOT EXISTS htmlxml_fts_bi BEFORE INSERT ON htmlxml BEGIN
+  DELETE FROM htmlxml_fts WHERE rowid IN (SELECT rowid FROM htmlxml WHERE html_url=new.html_url);
+END;
+""",
+    "htmlxml_fts_ai": """
+CREATE TRIGGER IF NOT EXISTS htmlxml_fts_ai AFTER INSERT ON htmlxml BEGIN
+  INSERT INTO htmlxml_fts(rowid, itemTitle, courseTitle) VALUES (new.rowid, new.itemTitle, new.courseTitle);
+END;
+""",
+    "htmlxml_fts_ad": """
+CREATE TRIGGER IF NOT EXISTS htmlxml_fts_ad AFTER DELETE ON htmlxml BEGIN
+  DELETE FROM htmlxml_fts WHERE rowid=old.rowid;
+END;
+""",
+    "htmlxml_fts_au": """
+CREATE TRIGGER IF NOT EXISTS htmlxml_fts_au AFTER UPDATE ON htmlxml BEGIN
+  DELETE FROM htmlxml_fts WHERE rowid=old.rowid;
+  INSERT INTO htmlxml_fts(rowid, itemTitle, courseTitle) VALUES (new.rowid, new.itemTitle, new.courseTitle);
+END;
+""",
+}
+
+create_unit_indexes = [
+    "CREATE INDEX IF NOT EXISTS idx_htmlxml_courseCode ON htmlxml (courseCode)",
+    "CREATE INDEX IF NOT EXISTS idx_htmlxml_itemTitle ON htmlxml (itemTitle)",
+]
+
+
+def create_unit_index(conn):
+    """Make sure the lookup indexes and the title search index exist.
+       If the search index or any of its triggers were missing, it is rebuilt.
+       Returns False if SQLite doesn't have FTS5, in which case search_units()
+       falls back to a LIKE scan. This writes to the database, so it is done
+       when the database is set up or migrated, and before units are converted."""
+    conn = connection(conn)
+    with conn:
+        for index in create_unit_indexes:
+            conn.execute(index)
+    names = {
+        name
+        for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE name=? OR tbl_name='htmlxml'", (UNIT_FTS,)
+        )
+    }
+    if UNIT_FTS in names and set(create_unit_fts_triggers).issubset(names):
+        return True
+    try:
+        with conn:
+            conn.execute(create_unit_fts)
+            for trigger in create_unit_fts_triggers.values():
+                conn.execute(trigger)
+    except sqlite3.OperationalError as e:
+        if "fts5" not in str(e):
+            raise
+        return False
+    rebuild_unit_index(conn)
+    return True
+
+
+def rebuild_unit_index(conn):
+    """Rebuild the title search index from the htmlxml table."""
+    conn = connection(conn)
+    with conn:
+        conn.execute("DELETE FROM htmlxml_fts")
+        conn.execute(
+            """INSERT INTO htmlxml_fts(rowid, itemTitle, courseTitle)
+               SELECT rowid, itemTitle, courseTitle FROM htmlxml"""
+        )
+
+
+def _columns_sql(columns, table="htmlxml"):
+    return ", ".join(
+        "{}.{}".format(table, c if c == "rowid" else "[{}]".format(c)) for c in columns
+    )
+
+
+def _lookup_sql(key, columns, limit=""):
+    if key not in LOOKUP_KEYS:
+        raise ValueError("Units can only be looked up by {}".format(", ".join(LOOKUP_KEYS)))
+    return "SELECT {} FROM htmlxml WHERE {}=? ORDER BY rowid {}".format(
+        _columns_sql(columns), key if key == "rowid" else "[{}]".format(key), limit
+    )
+
+
+def get_unit(conn, key, value, columns=UNIT_COLUMNS):
+    """Get the (first) unit whose key column is exactly value, as a dict, or None.
+       key is one of LOOKUP_KEYS, eg get_unit(conn, "html_url", url)."""
+    return query_row(conn, _lookup_sql(key, columns, "LIMIT 1"), (value,))
+
+
+def get_units(conn, key, value, columns=UNIT_COLUMNS):
+    """Get all the units whose key column is exactly value, eg all the units for a courseCode."""
+    return list(query_rows(conn, _lookup_sql(key, columns), (value,)))
+
+
+def fts_query(term):
+    """Turn a search term into an FTS5 query that matches every word in it as a prefix."""
+    words = re.findall(r"\w+", term)
+    return " ".join('"{}"*'.format(w) for w in words)
+
+
+def has_unit_index(conn):
+    """Whether the title search index exists; checking doesn't write to the database."""
+    return query_row(
+        conn, "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (UNIT_FTS,)
+    ) is not None
+
+
+def search_units(conn, term, limit=None, columns=UNIT_COLUMNS):
+    """Find the units whose item or course title contains words starting with
+       each of the words in term, best matches first. An empty term matches every unit.
+       Databases without the search index are searched with a LIKE scan instead."""
+    query = fts_query(term)
+    if not query:
+        sql = "SELECT {} FROM htmlxml ORDER BY rowid".format(_columns_sql(columns))
+        params = []
+    elif has_unit_index(conn):
+        sql = """SELECT {} FROM htmlxml_fts JOIN htmlxml ON htmlxml.rowid=htmlxml_fts.rowid
+                 WHERE htmlxml_fts MATCH ? ORDER BY htmlxml_fts.rank""".format(
+            _columns_sql(columns)
+        )
+        params = [query]
+    else:
+        sql = """SELECT {} FROM htmlxml
+                 WHERE LOWER(itemTitle) LIKE ? OR LOWER(courseTitle) LIKE ?
+                 ORDER BY rowid""".format(_columns_sql(columns))
+        params = ["%{}%".format(term.lower())] * 2
+    if limit:
+        sql = "{} LIMIT {:d}".format(sql, limit)
+    return list(query_rows(conn, sql, params))
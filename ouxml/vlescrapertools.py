@@ -16,14 +16,14 @@
 
 # Tools to support the scraping of the OU Moodle VLE
 
-import time
-import random
-import mechanicalsoup
-from bs4 import BeautifulSoup
+# BeautifulSoup is slow to import, so it is imported where it is used
+
+from ouxml.fetcher import get_fetcher
 
 # This is not used at the moment?
 def _html_title(html_content):
     """ Get the title of an HTML page. """
+    from bs4 import BeautifulSoup
 
     soup = BeautifulSoup(html_content, "lxml")
     return soup.find("title").text.split("-")[0]
@@ -32,15 +32,14 @@ def _html_title(html_content):
 def _get_page(s, url):
     """ Utility function to play nice when scraping. """
 
-    # Play nice
-    time.sleep(random.uniform(0.1, 0.3))
-
-    r = s.open(url)
+    # Play nice: the fetcher rate limits requests to each host
+    r = get_fetcher().get(url, s)
     return r
 
 
 def _search_by_code(s, code=None, service="learn2"):
     """ Search VLE for modules with a particular module code. """
+    from bs4 import BeautifulSoup
 
     if not code:
         code = input("Module code (e.g. TM129 or TM129-17J): ")
@@ -126,6 +125,7 @@ def _get_potential_sc_links(soup, optimise=True):
 
 def _html_sc_links(html_content, optimise=True):
     """ Try to identify page URLs for pages generated from a structured content document. """
+    from bs4 import BeautifulSoup
 
     soup = BeautifulSoup(html_content, "lxml")
     calendar = soup.find("ul", {"class": "oustudyplan"})
@@ -147,6 +147,7 @@ def get_possible_sc_links_from_page(s, pages, sid="", classname=""):
     """ Get list of links that may point to VLE HTML pages
         derived from a target page or pages on the VLE. 
     """
+    from bs4 import BeautifulSoup
 
     pages = [pages] if isinstance(pages, str) else pages
 
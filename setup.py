@@ -26,9 +26,13 @@ setup(
         [console_scripts]
         ouxml_grab = ouxml.cli:get_xml
         ouxml_units = ouxml.cli:get_units
+        ouxml_harvest = ouxml.cli:harvest
         ouxml_db_units = ouxml.cli:get_db_units
+        ouxml_index = ouxml.cli:index_sections
+        ouxml_search = ouxml.cli:search_sections
         ouxml2md = ouxml.cli:ouxml2md_conversion
         ouxmlfile2md = ouxml.cli:xmlfile2md
         ouxmlcleanmd = ouxml.cli:clean_md
+        ouxml_migrate = ouxml.cli:migrate_db
     ''',
 )
@@ -0,0 +1,90 @@
+# figures_memory.py
+
+# Compare the peak memory and time of extracting figure records from an OU-XML
+# document with a fully parsed tree and with iter_figures() streaming the XML.
+#
+# A synthetic document is generated (see synthetic_ouxml.py), and each way of
+# extracting its figures is run in a fresh process so that their peak resident
+# set sizes can be compared. The scrapers pass the parsed tree they already have,
+# so streaming only helps callers that start from the XML.
+#
+# Usage: python utils/figures_memory.py [--sessions N] [--runs N]
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic_ouxml
+
+
+def extract(mode, path):
+    """Extract the figure records from an OU-XML file; returns the number of records."""
+    from lxml import etree
+    import ouxml.moodlescraper as mscpr
+
+    with open(path, "rb") as f:
+        data = f.read()
+    if mode == "tree":
+        figures = mscpr.iter_figures(root=etree.fromstring(data))
+    else:
+        figures = mscpr.iter_figures(data)
+    records = mscpr._figure_records(
+        figures, mscpr._xml_figure_record_openlearn, mscpr.FIGURE_TAGS
+    )
+    return len(records)
+
+
+def run(mode, path):
+    """Run one extraction in this process and report on it."""
+    # Load the modules first, so only the extraction counts
+    import lxml.etree
+    import ouxml.moodlescraper
+
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    n = extract(mode, path)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+    # ru_maxrss is in KB on Linux
+    print("{} {} {:.1f} {:.3f}".format(mode, n, peak / 1024, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=250, help="Sessions in the document (default: 250)")
+    parser.add_argument("--runs", type=int, default=3, help="Runs of each mode (default: 3)")
+    parser.add_argument("--run", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.run:
+        run(*opts.run)
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "unit.xml")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(synthetic_ouxml.document(opts.sessions, 4, 20))
+        print("Document: {:.1f} MB".format(os.path.getsize(path) / 1024 / 1024))
+        for mode in ["tree", "stream"]:
+            results = []
+            for _ in range(opts.runs):
+                out = subprocess.run(
+                    [sys.executable, __file__, "--run", mode, path],
+                    stdout=subprocess.PIPE,
+                    universal_newlines=True,
+                    check=True,
+                ).stdout.split()
+                results.append((float(out[2]), float(out[3]), int(out[1])))
+            peak = min(r[0] for r in results)
+            elapsed = min(r[1] for r in results)
+            print(
+                "{:<7} {} records, peak RSS +{:.1f} MB, {:.2f}s".format(mode, results[0][2], peak, elapsed)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# flatten_benchmark.py
+
+# Micro-benchmark flatten() against the recursive version it replaced, on
+# deeply nested descriptions, typical figure fields and whole sessions, and
+# across the figure extraction for a unit.
+#
+# The recursive version normalised the text at every level of nesting, so its
+# cost grows with the square of the depth. The outputs of the two versions are
+# checked to be the same for every case.
+#
+# Usage: python utils/flatten_benchmark.py [--sessions N] [--runs N]
+
+import argparse
+import time
+import unicodedata
+
+import synthetic_ouxml
+
+
+def flatten_recursive(el):
+    """flatten() as it was before it walked the tree iteratively."""
+    if el is None:
+        return ""
+    result = [(el.text or "")]
+    for sel in el:
+        result.append(flatten_recursive(sel))
+        result.append(sel.tail or "")
+    return unicodedata.normalize("NFKD", "".join(result)) or " "
+
+
+def nested_description(depth):
+    """A description with paragraphs nested depth deep."""
+    from lxml import etree
+
+    xml = "<Description>" + "<Paragraph>ﬁrst <b>café</b> ".join([""] * (depth + 1))
+    xml += "</Paragraph> tail".join([""] * (depth + 1)) + "</Description>"
+    return etree.fromstring(xml)
+
+
+def best(fn, items, runs):
+    """Best time over runs of calling fn on each item, in us per item."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        times.append(time.perf_counter() - start)
+    return min(times) / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=50, help="Sessions in the unit (default: 50)")
+    parser.add_argument("--runs", type=int, default=5, help="Runs of each case (default: 5)")
+    opts = parser.parse_args()
+
+    from lxml import etree
+    import ouxml.moodlescraper as mscpr
+
+    flatten = mscpr.flatten
+    root = etree.fromstring(synthetic_ouxml.document(opts.sessions, 4, 8).encode("utf-8"))
+    figures = list(mscpr.iter_figures(root=root))
+    cases = [
+        ("nested description, depth 10", [nested_description(10)] * 100),
+        ("nested description, depth 50", [nested_description(50)] * 20),
+        ("nested description, depth 200", [nested_description(200)] * 5),
+        ("figure caption", list(root.iter("Caption"))),
+        ("figure description", list(root.iter("Description"))),
+        ("whole session", list(root.iter("Session"))),
+    ]
+
+    print(
+        "{:<32} {:>12} {:>12}  (us per call, best of {})".format(
+            "", "recursive", "iterative", opts.runs
+        )
+    )
+    for name, items in cases:
+        same = all(flatten_recursive(el) == flatten(el) for el in items)
+        print(
+            "{:<32} {:>12.1f} {:>12.1f}{}".format(
+                name,
+                best(flatten_recursive, items, opts.runs),
+                best(flatten, items, opts.runs),
+                "" if same else "  OUTPUT DIFFERS",
+            )
+        )
+
+    # The figure records for the whole unit, with each version in place
+    def records(figure):
+        mscpr._xml_figure_record_openlearn(figure, "B100", "https://example.org/unit")
+
+    times = []
+    try:
+        for fn in [flatten_recursive, flatten]:
+            mscpr.flatten = fn
+            times.append(best(records, figures, opts.runs) * len(figures) / 1000)
+    finally:
+        mscpr.flatten = flatten
+    print(
+        "{:<32} {:>10.1f}ms {:>10.1f}ms  ({} figures)".format(
+            "figure records for the unit", times[0], times[1], len(figures)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# image_mapper_benchmark.py
+
+# Time openlearn_image_mapper() over the markdown files of a large unit.
+#
+# A synthetic unit (50 sessions by default, see synthetic_ouxml.py) is stored
+# in a scratch database along with its figures and some made up image data,
+# as a scrape would leave them, and converted to markdown files. Each run then
+# maps the images for a fresh copy of the files, and the best time is reported.
+#
+# Usage: python utils/image_mapper_benchmark.py [--sessions N] [--runs N]
+
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+import synthetic_ouxml
+
+
+def make_unit(dbname, mddir, sessions):
+    """Store a synthetic unit, its figures and images in a database,
+       and convert it to markdown files in mddir."""
+    from lxml import etree
+    import ouxml.moodlescraper as mscpr
+    from ouxml.OU_XML2md_Converter import transform_xml2md
+
+    xml = synthetic_ouxml.document(sessions, 4, 8, title="Big unit", code="B50", seed=5)
+    url = "https://example.org/big"
+    with contextlib.redirect_stdout(io.StringIO()):
+        DB = mscpr.setup_DB(dbname, newdb=True)
+    DB["htmlxml"].insert(
+        {
+            "possible_sc_link": url,
+            "doctype": "XML",
+            "html_url": url,
+            "xml": xml,
+            "courseCode": "B50",
+            "courseTitle": "Course B50",
+            "itemTitle": "Big unit",
+        }
+    )
+    figures = mscpr._figure_records(
+        mscpr.iter_figures(xml.encode("utf-8")),
+        mscpr._xml_figure_record_openlearn,
+        mscpr.FIGURE_TAGS,
+        "B50",
+        url,
+    )
+    DB["xmlfigures"].insert_all(figures, alter=True)
+    # Some made up image data for each distinct image
+    stubs = {figure["stub"]: figure for figure in figures}
+    with DB.conn:
+        for stub, figure in stubs.items():
+            data = hashlib.sha256(stub.encode("utf-8")).digest() * 200
+            DB["imagetest"].insert(
+                {
+                    "stub": stub,
+                    "minstub": figure["minstub"],
+                    "hash": mscpr._store_image(DB.conn, data),
+                    "x_contenthash": figure["x_contenthash"],
+                }
+            )
+    DB.conn.close()
+
+    transform_xml2md(etree.fromstring(xml.encode("utf-8")), output_path_stub=os.path.join(mddir, "Part"))
+    return len(figures), len(stubs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=50, help="Sessions in the unit (default: 50)")
+    parser.add_argument("--runs", type=int, default=5, help="Timed runs (default: 5)")
+    opts = parser.parse_args()
+
+    from ouxml.OU_XML2md_Converter import openlearn_image_mapper
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbname = os.path.join(tmpdir, "unit.db")
+        mddir = os.path.join(tmpdir, "md")
+        n_figures, n_images = make_unit(dbname, mddir, opts.sessions)
+        n_files = len([fn for fn in os.listdir(mddir) if fn.endswith(".md")])
+        print("{} markdown files, {} figures, {} images".format(n_files, n_figures, n_images))
+
+        times = []
+        for _ in range(opts.runs):
+            rundir = os.path.join(tmpdir, "run")
+            shutil.rmtree(rundir, ignore_errors=True)
+            shutil.copytree(mddir, rundir)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                openlearn_image_mapper(dbname, rundir, "images")
+            times.append(time.perf_counter() - start)
+        written = len(os.listdir(os.path.join(rundir, "images")))
+
+    print(
+        "openlearn_image_mapper: best {:.3f}s of {} runs, {} image files".format(
+            min(times), opts.runs, written
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# importtime_budget.py
+
+# Check the import time of each ouxml command line entry point against a budget.
+#
+# Each entry point is run as cheaply as it can be (mostly with --help) under
+# python -X importtime, and the time spent importing modules is totalled.
+# The best of several runs is compared with the budget for the entry point,
+# and the script exits with status 1 if any of them goes over.
+#
+# Usage: python utils/importtime_budget.py [--runs N] [--verbose]
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+# Entry point -> (cli function, arguments, import time budget in ms)
+# The budgets leave some headroom over the measured times; if an entry point
+# goes over, check that a heavy module hasn't crept back into a top level import.
+# "{tmpdir}" is replaced with an empty temporary directory.
+ENTRY_POINTS = {
+    "ouxml_grab": ("get_xml", ["--help"], 100),
+    "ouxml_units": ("get_units", ["--help"], 100),
+    "ouxml_harvest": ("harvest", ["--help"], 100),
+    "ouxml_db_units": ("get_db_units", ["--help"], 100),
+    "ouxml_index": ("index_sections", ["--help"], 100),
+    "ouxml_search": ("search_sections", ["--help"], 100),
+    "ouxml2md": ("ouxml2md_conversion", ["--help"], 100),
+    "ouxmlfile2md": ("xmlfile2md", ["--help"], 100),
+    "ouxmlcleanmd": ("clean_md", ["{tmpdir}"], 100),
+    "ouxml_migrate": ("migrate_db", ["--help"], 100),
+}
+
+
+def import_time(fn, args):
+    """Run an entry point and return the total time, in ms, spent importing modules."""
+    code = "import sys; from ouxml.cli import {}; {}(sys.argv[1:])".format(fn, fn)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    total = 0
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith("import time:"):
+            self_us = line.split(":", 1)[1].split("|")[0].strip()
+            if self_us.isdigit():
+                total += int(self_us)
+    return total / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5, help="Runs per entry point (default: 5)")
+    parser.add_argument("--verbose", action="store_true", help="Report every run")
+    opts = parser.parse_args()
+
+    failed = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, (fn, args, budget) in ENTRY_POINTS.items():
+            args = [arg.format(tmpdir=tmpdir) for arg in args]
+            times = [import_time(fn, args) for _ in range(opts.runs)]
+            best = min(times)
+            status = "ok" if best <= budget else "OVER BUDGET"
+            print("{:<16} {:7.1f}ms (budget {}ms) {}".format(name, best, budget, status))
+            if opts.verbose:
+                print("    " + ", ".join("{:.1f}".format(t) for t in times))
+            if best > budget:
+                failed.append(name)
+
+    if failed:
+        print("Import time over budget: {}".format(", ".join(failed)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
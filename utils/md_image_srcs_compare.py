@@ -0,0 +1,111 @@
+# md_image_srcs_compare.py
+
+# Compare the image sources found in markdown files by iter_md_image_srcs(),
+# which scans the markdown text, with the rendering extractor it replaced,
+# which converts the markdown to HTML with the ImgExtractor extension and
+# collects the img tags.
+#
+# Give it directories of converted markdown (eg the output of ouxml2md) or
+# markdown files; with none, a synthetic unit (see synthetic_ouxml.py) is
+# converted to compare against. Each file where the two disagree is reported.
+# Some differences are expected: the renderer has no fenced code support, so it
+# reports images in ```code blocks that contain blank lines, and it returns
+# backslash escapes as internal placeholders. The script exits with status 1
+# if the image keys derived from the sources differ for any file.
+#
+# Usage: python utils/md_image_srcs_compare.py [--verbose] [PATH ...]
+
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import synthetic_ouxml
+
+
+def rendered_image_srcs(md_raw):
+    """The image sources found by rendering the markdown, as get_imgkeys_from_md() used to."""
+    import markdown
+    from ouxml.OU_XML2md_Converter import ImgExtExtension
+
+    # A fresh instance for each file, so nothing carries over between them
+    md = markdown.Markdown(extensions=[ImgExtExtension()])
+    md.convert(md_raw)
+    return md.images
+
+
+def markdown_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "**", "*.md"), recursive=True)))
+        else:
+            files.append(path)
+    return files
+
+
+def compare(files, verbose=False):
+    """Compare the extractors over some markdown files; returns the number of
+       files whose image keys differ."""
+    from ouxml.OU_XML2md_Converter import imgkeys_from_srcs, iter_md_image_srcs
+
+    n_images = n_src_diffs = n_key_diffs = 0
+    rendered_time = scanned_time = 0
+    for fn in files:
+        with open(fn, encoding="utf-8") as f:
+            md_raw = f.read()
+        start = time.perf_counter()
+        rendered = rendered_image_srcs(md_raw)
+        rendered_time += time.perf_counter() - start
+        start = time.perf_counter()
+        scanned = list(iter_md_image_srcs(md_raw))
+        scanned_time += time.perf_counter() - start
+        n_images += len(rendered)
+        if rendered == scanned:
+            continue
+        n_src_diffs += 1
+        keys_differ = set(imgkeys_from_srcs(rendered).values()) != set(
+            imgkeys_from_srcs(scanned).values()
+        )
+        n_key_diffs += keys_differ
+        print("{}: sources differ{}".format(fn, ", image keys differ" if keys_differ else ""))
+        if verbose or keys_differ:
+            print("    rendered: {}".format([src for src in rendered if src not in scanned]))
+            print("    scanned:  {}".format([src for src in scanned if src not in rendered]))
+
+    print(
+        "{} files, {} images: sources differ in {} files, image keys in {}".format(
+            len(files), n_images, n_src_diffs, n_key_diffs
+        )
+    )
+    print(
+        "Extraction time: rendering {:.0f}ms, scanning {:.0f}ms".format(
+            rendered_time * 1000, scanned_time * 1000
+        )
+    )
+    return n_key_diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("paths", nargs="*", help="Markdown files or directories of them")
+    parser.add_argument("--verbose", action="store_true", help="Show every difference")
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = opts.paths
+        if not paths:
+            from ouxml.OU_XML2md_Converter import transform_xml2md
+
+            transform_xml2md(
+                synthetic_ouxml.document(50, 4, 8), output_path_stub=os.path.join(tmpdir, "Part")
+            )
+            paths = [tmpdir]
+        if compare(markdown_files(paths), opts.verbose):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# synthetic_ouxml.py
+
+# Generate synthetic OU-XML documents for the benchmark scripts in utils/,
+# so they can be run without scraping anything.
+# Each section has a few paragraphs with inline figures, some figures with
+# captions and descriptions, an equation and some other common elements.
+#
+# Usage: python utils/synthetic_ouxml.py [SESSIONS [SECTIONS [FIGURES]]] > unit.xml
+
+import random
+import sys
+
+IMAGE_BASE = "https://www.open.edu/openlearn/pluginfile.php/1/mod_oucontent/oucontent/99"
+
+
+def figure(i, tag="Figure"):
+    """A figure with an image, caption, alternative text, description and rights."""
+    name = "img_{:03d}.png".format(i % 37)
+    caption = (
+        "<Caption><Number>Figure {}</Number> A caption with café &amp; <i>italics</i></Caption>".format(i)
+        if tag == "Figure"
+        else ""
+    )
+    return (
+        '<{tag}><Image src="{base}/{name}" x_folderhash="f{h:04x}" x_contenthash="c{h:08x}" '
+        'x_imagesrc="{name}"/>{caption}<Alternative>Alt {i} ﬁgure</Alternative>'
+        "<Description><Paragraph>Description <b>{i}</b></Paragraph></Description>"
+        "<SourceReference><ItemRights><OwnerRef/><ItemRef/>"
+        "<ItemAcknowledgement>Ack {i}</ItemAcknowledgement></ItemRights></SourceReference>"
+        "</{tag}>"
+    ).format(tag=tag, base=IMAGE_BASE, name=name, h=i % 37, caption=caption, i=i)
+
+
+def document(sessions=5, sections=4, figures=3, paragraphs=5, title="Test unit", code="B100", seed=0):
+    """Get a synthetic OU-XML document as a string."""
+    r = random.Random(seed)
+    out = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        "<Item><CourseCode>{code}-22J</CourseCode><CourseTitle>Course {code}</CourseTitle>"
+        "<ItemTitle>{title}</ItemTitle><Unit><UnitTitle>{title}</UnitTitle>".format(code=code, title=title),
+    ]
+    n = 0
+    for session in range(sessions):
+        out.append("<Session><Title>Session {} title ü</Title>".format(session))
+        for section in range(sections):
+            out.append("<Section><Title>Section {}.{}</Title>".format(session, section))
+            for p in range(paragraphs):
+                out.append(
+                    "<Paragraph>Text {:.5f} with &lt;tag&gt; &amp; “quotes” and <b>bold</b> "
+                    '<InlineFigure><Image src="{base}/inl_{i}.png" x_folderhash="ab" '
+                    'x_contenthash="i{i}" x_imagesrc="inl_{i}.png"/></InlineFigure></Paragraph>'.format(
+                        r.random(), base=IMAGE_BASE, i=p % 5
+                    )
+                )
+            for _ in range(figures):
+                n += 1
+                out.append(figure(n))
+            out.append("<Quote><Paragraph>Quoted {}</Paragraph></Quote>".format(section))
+            out.append(
+                '<ComputerDisplay><Paragraph>a &lt; b<br/>print("x")</Paragraph></ComputerDisplay>'
+            )
+            out.append(
+                '<Equation><Image src="{base}/eq_{i}.gif" x_folderhash="ab" x_contenthash="e{i}" '
+                'x_imagesrc="eq_{i}.gif"/></Equation>'.format(base=IMAGE_BASE, i=n % 7)
+            )
+            out.append("</Section>")
+        out.append("</Session>")
+    out.append(
+        "<Backmatter><Glossary><GlossaryItem><Term>T</Term><Definition>D ©</Definition>"
+        "</GlossaryItem></Glossary></Backmatter>"
+    )
+    out.append("</Unit></Item>")
+    return "\n".join(out)
+
+
+if __name__ == "__main__":
+    sys.stdout.write(document(*[int(arg) for arg in sys.argv[1:4]]))
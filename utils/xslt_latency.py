@@ -0,0 +1,72 @@
+# xslt_latency.py
+
+# Measure the per-document latency of converting OU-XML to markdown with
+# transform_xml2md(), with the stylesheet compiled for every document (as it
+# was before compiled transformers were cached) and with the cached transformer.
+#
+# A small synthetic unit is generated (see synthetic_ouxml.py) and converted
+# a number of times each way, writing the markdown files to a temporary
+# directory, and also in memory. The outputs of the cached and uncached runs
+# are checked to be the same.
+#
+# Usage: python utils/xslt_latency.py [--sessions N] [--runs N] [--xml FILE]
+
+import argparse
+import os
+import tempfile
+import time
+
+import synthetic_ouxml
+
+
+def outputs(outdir):
+    """Get the files in a directory as a dict of relative path -> content."""
+    files = {}
+    for dirpath, _, filenames in os.walk(outdir):
+        for fn in filenames:
+            path = os.path.join(dirpath, fn)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, outdir)] = f.read()
+    return files
+
+
+def latency(xml, outdir, runs, cached=True, in_memory=False):
+    """Convert a document runs times and return the mean ms per document."""
+    from ouxml.OU_XML2md_Converter import clear_xslt_cache, transform_xml2md
+
+    clear_xslt_cache()
+    start = time.perf_counter()
+    for _ in range(runs):
+        if not cached:
+            clear_xslt_cache()
+        transform_xml2md(xml, output_path_stub=os.path.join(outdir, "Part"), in_memory=in_memory)
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=3, help="Sessions in the unit (default: 3)")
+    parser.add_argument("--runs", type=int, default=200, help="Documents converted each way (default: 200)")
+    parser.add_argument("--xml", help="Convert this OU-XML file instead of a synthetic unit")
+    opts = parser.parse_args()
+
+    if opts.xml:
+        with open(opts.xml, encoding="utf-8") as f:
+            xml = f.read()
+    else:
+        xml = synthetic_ouxml.document(opts.sessions, 4, 3)
+
+    with tempfile.TemporaryDirectory() as uncached_dir, tempfile.TemporaryDirectory() as cached_dir:
+        uncached = latency(xml, uncached_dir, opts.runs, cached=False)
+        cached = latency(xml, cached_dir, opts.runs)
+        in_memory = latency(xml, cached_dir, opts.runs, in_memory=True)
+        same = outputs(uncached_dir) == outputs(cached_dir)
+
+    print("uncached   {:6.2f} ms/doc".format(uncached))
+    print("cached     {:6.2f} ms/doc".format(cached))
+    print("in memory  {:6.2f} ms/doc".format(in_memory))
+    print("outputs {}".format("identical" if same else "DIFFER"))
+
+
+if __name__ == "__main__":
+    main()